@@ -1,16 +1,302 @@
 from laspy.file import File
-from scipy.spatial.kdtree import KDTree
+from scipy.spatial import cKDTree
+from collections import namedtuple
+from itertools import chain
+import os
+import struct
+import zlib
 import numpy as np
-import matplotlib.pyplot as plt
 
+# number of point records read per chunk
+CHUNK_SIZE = 1000000
 
-def scaled_x_dimension(las_file):
-    """ Grab just the X dimension from the file, and scale it. """
+# points x ring edges tested per block in the point in polygon test
+PIP_BLOCK = 1 << 20
 
-    x_dimension = las_file.X
-    scale = las_file.header.scale[0]
-    offset = las_file.header.offset[0]
-    return x_dimension * scale + offset
+# per vertex Z statistics, the sorted candidate Z's of vertex i are
+# z_values[z_offsets[i]:z_offsets[i + 1]]
+ZSample = namedtuple('ZSample', ['z_min', 'z_max', 'z_med', 'z_range', 'z_values', 'z_offsets'])
+
+# LAS elevation statistics of the points inside each polygon, plus its planar area
+ZoneStats = namedtuple('ZoneStats', ['count', 'z_min', 'z_max', 'z_mean', 'z_std', 'z_median', 'z_sum', 'area'])
+
+
+def read_las_header(las_path):
+    """ Read the parts of the public header block needed to map the point
+    records: data offset, point format, record length, count, scale and offset. """
+
+    with open(las_path, 'rb') as f:
+        block = f.read(375)
+    if block[:4] != b'LASF':
+        raise IOError("Not a LAS file: " + str(las_path))
+    version = struct.unpack('<BB', block[24:26])
+    point_count = struct.unpack('<I', block[107:111])[0]
+    if version >= (1, 4) and len(block) >= 255:
+        # LAS 1.4 keeps the full count in a 64 bit field, the legacy one may be 0
+        point_count = max(point_count, struct.unpack('<Q', block[247:255])[0])
+    return {'version': version,
+            'data_offset': struct.unpack('<I', block[96:100])[0],
+            'point_format': struct.unpack('<B', block[104:105])[0] & 0x3F,
+            'record_length': struct.unpack('<H', block[105:107])[0],
+            'point_count': point_count,
+            'scale': np.array(struct.unpack('<3d', block[131:155])),
+            'offset': np.array(struct.unpack('<3d', block[155:179]))}
+
+
+def las_point_dtype(header):
+    """ Structured dtype over the leading fields every point format shares,
+    the rest of each record is skipped by the itemsize """
+
+    return np.dtype({'names': ['X', 'Y', 'Z', 'intensity', 'return_byte'],
+                     'formats': ['<i4', '<i4', '<i4', '<u2', 'u1'],
+                     'offsets': [0, 4, 8, 12, 14],
+                     'itemsize': header['record_length']})
+
+
+def iter_las_chunks(las_path, chunk_size=CHUNK_SIZE):
+    """ Memory map the point records and yield fixed size structured views.
+    Only the pages of the chunk being worked on are ever read. """
+
+    header = read_las_header(las_path)
+    if header['point_count'] == 0:
+        return
+    points = np.memmap(las_path, dtype=las_point_dtype(header), mode='r',
+                       offset=header['data_offset'], shape=(header['point_count'],))
+    for start in range(0, len(points), chunk_size):
+        yield points[start:start + chunk_size]
+
+
+def scale_chunk(chunk, header):
+    """ return the scaled X, Y, Z of a chunk as an (n, 3) array """
+
+    xyz = np.empty((len(chunk), 3))
+    for i, dim in enumerate(('X', 'Y', 'Z')):
+        xyz[:, i] = chunk[dim] * header['scale'][i] + header['offset'][i]
+    return xyz
+
+
+def return_numbers(chunk, header):
+    """ return the return number and number of returns of a chunk """
+
+    flags = chunk['return_byte']
+    if header['point_format'] >= 6:
+        return flags & 0x0F, flags >> 4
+    return flags & 0x07, (flags >> 3) & 0x07
+
+
+def scaled_x_dimension(las_path, chunk_size=CHUNK_SIZE):
+    """ Grab just the X dimension from the file, and scale it a chunk at a time. """
+
+    header = read_las_header(las_path)
+    scale = header['scale'][0]
+    offset = header['offset'][0]
+    for chunk in iter_las_chunks(las_path, chunk_size):
+        yield chunk['X'] * scale + offset
+
+
+class LasIndex(object):
+    """ Spatial index of a LAS tile. The 2D and 3D trees are only built when
+    first asked for. The points they are built from are cached next to the
+    tile as plain .npz arrays (never pickles, tiles often sit on shared
+    drives), keyed by the tile's mtime, size and CRC-32, so later runs skip
+    decoding the tile and only rebuild the tree. """
+
+    def __init__(self, las_path, use_cache=True):
+        self.las_path = las_path
+        self.use_cache = use_cache
+        self._xyz = None
+        self._trees = {}
+        self._key_value = None
+
+    @property
+    def xyz(self):
+        """ scaled (n, 3) point array, read once through the chunk reader """
+
+        if self._xyz is None:
+            header = read_las_header(self.las_path)
+            xyz = np.empty((header['point_count'], 3))
+            start = 0
+            for chunk in iter_las_chunks(self.las_path):
+                xyz[start:start + len(chunk)] = scale_chunk(chunk, header)
+                start += len(chunk)
+            self._xyz = xyz
+        return self._xyz
+
+    @property
+    def tree2d(self):
+        return self._tree(2)
+
+    @property
+    def tree3d(self):
+        return self._tree(3)
+
+    def cache_path(self, dims):
+        return os.path.splitext(self.las_path)[0] + "_%id.kdtree.npz" % dims
+
+    def _key(self):
+        """ mtime, size and CRC-32 of the tile, the CRC catches a rewrite that
+        keeps the size within one mtime tick """
+
+        if self._key_value is None:
+            stat = os.stat(self.las_path)
+            crc = 0
+            with open(self.las_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 24), b''):
+                    crc = zlib.crc32(block, crc)
+            self._key_value = np.array([stat.st_mtime, stat.st_size, crc & 0xffffffff])
+        return self._key_value
+
+    def _tree(self, dims):
+        if dims not in self._trees:
+            data = self._load(dims) if self.use_cache else None
+            if data is None:
+                data = np.ascontiguousarray(self.xyz[:, :dims])
+                if self.use_cache:
+                    self._save(dims, data)
+            self._trees[dims] = cKDTree(data)
+        return self._trees[dims]
+
+    def _load(self, dims):
+        """ return the cached tree points, or None if they are missing or stale """
+
+        path = self.cache_path(dims)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as cache:
+                if not np.array_equal(cache['key'], self._key()):
+                    return None
+                data = cache['data']
+            return data if data.ndim == 2 and data.shape[1] == dims else None
+        except Exception:
+            # partial or unreadable cache, just rebuild it
+            return None
+
+    def _save(self, dims, data):
+        path = self.cache_path(dims)
+        try:
+            with open(path, 'wb') as f:
+                np.savez(f, key=self._key(), data=data)
+        except (IOError, OSError):
+            # read only folder, the tree is still good for this run
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _query(method, *args, **kwargs):
+    """ call a cKDTree query on `workers` threads, under whichever keyword the
+    installed scipy takes (workers, n_jobs before 1.6, neither before that) """
+
+    workers = kwargs.pop('workers', 1)
+    if workers != 1:
+        for name in ('workers', 'n_jobs'):
+            try:
+                return method(*args, **dict(kwargs, **{name: workers}))
+            except TypeError:
+                pass
+    return method(*args, **kwargs)
+
+
+def sample_z(tree2d, z, xy, radius=.5, k=6, workers=1):
+    """ Sample the lidar Z's around an (n, 2) array of vertices in one pass.
+    Each vertex takes the points within radius of it, or its k nearest points
+    when the ball is empty, rounded to 2 decimals. The tree queries run on
+    workers threads (-1 for every core). Returns a ZSample. """
+
+    xy = np.atleast_2d(np.asarray(xy, dtype=float))[:, :2]
+    balls = _query(tree2d.query_ball_point, xy, radius, workers=workers)
+    counts = np.fromiter((len(ball) for ball in balls), dtype=np.intp, count=len(xy))
+    idx = np.fromiter(chain.from_iterable(balls), dtype=np.intp, count=counts.sum())
+    owner = np.repeat(np.arange(len(xy)), counts)
+
+    # only the vertices with an empty ball fall back to a k nearest query
+    empty = np.flatnonzero(counts == 0)
+    if len(empty):
+        nn = _query(tree2d.query, xy[empty], min(k, tree2d.n), workers=workers)[1].reshape(len(empty), -1)
+        counts[empty] = nn.shape[1]
+        idx = np.concatenate([idx, nn.ravel()])
+        owner = np.concatenate([owner, np.repeat(empty, nn.shape[1])])
+
+    values = np.round(z[idx], 2)
+    order = np.lexsort((values, owner))
+    values = values[order]
+    offsets = np.zeros(len(xy) + 1, dtype=np.intp)
+    np.cumsum(counts, out=offsets[1:])
+
+    z_min = values[offsets[:-1]]
+    z_max = values[offsets[1:] - 1]
+    z_med = (values[offsets[:-1] + (counts - 1) // 2] + values[offsets[:-1] + counts // 2]) / 2.0
+    return ZSample(z_min, z_max, z_med, z_max - z_min, values, offsets)
+
+
+def sample_z_parallel(index, xy, workers=1, radius=.5, k=6):
+    """ sample_z against the index's 2D tree with the queries spread over
+    workers threads of cKDTree itself. The tree is built (or loaded from the
+    tile's cache) once in this process and shared by every thread, nothing is
+    copied to or rebuilt in other processes. """
+
+    return sample_z(index.tree2d, index.xyz[:, 2], xy, radius, k, workers)
+
+
+def points_in_ring(points, ring):
+    """ Even-odd point in polygon test of an (n, 2) array of points against a
+    closed ring. Points are tested against every edge at once, in blocks of
+    about PIP_BLOCK point-edge pairs to bound the temporaries. """
+
+    x0, y0 = ring[:-1, 0], ring[:-1, 1]
+    x1, y1 = ring[1:, 0], ring[1:, 1]
+    slope = (x1 - x0) / np.where(y1 != y0, y1 - y0, 1)
+    inside = np.zeros(len(points), dtype=bool)
+    step = max(1, PIP_BLOCK // max(len(x0), 1))
+    for start in range(0, len(points), step):
+        px = points[start:start + step, :1]
+        py = points[start:start + step, 1:2]
+        crosses = (y0 > py) != (y1 > py)
+        crosses &= px < x0 + (py - y0) * slope
+        inside[start:start + step] = np.count_nonzero(crosses, axis=1) % 2 == 1
+    return inside
+
+
+def zonal_stats(index, xy, offsets):
+    """ Elevation statistics of the LAS points inside each polygon ring, ring i
+    is xy[offsets[i]:offsets[i + 1]]. Candidate points come from the 2D tree
+    within the ring's bounding circle, are cut to its bounding box and then
+    tested against the ring itself, no rasterizing. Rings with no points get a
+    0 count and NaN statistics. Returns a ZoneStats of arrays. """
+
+    xy = np.asarray(xy, dtype=float)[:, :2]
+    count = len(offsets) - 1
+    stats = dict((field, np.full(count, np.nan)) for field in ZoneStats._fields)
+    stats['count'] = np.zeros(count, dtype=np.int64)
+    tree = index.tree2d
+    points = index.xyz
+
+    for i in range(count):
+        ring = xy[offsets[i]:offsets[i + 1]]
+        if len(ring) < 3:
+            stats['area'][i] = 0.0
+            continue
+        if np.any(ring[0] != ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        stats['area'][i] = abs(np.dot(ring[:-1, 0], ring[1:, 1]) - np.dot(ring[1:, 0], ring[:-1, 1])) / 2.0
+
+        low, high = ring.min(axis=0), ring.max(axis=0)
+        idx = np.asarray(tree.query_ball_point((low + high) / 2, np.hypot(*(high - low)) / 2), dtype=np.intp)
+        if len(idx):
+            in_box = np.all((points[idx, :2] >= low) & (points[idx, :2] <= high), axis=1)
+            idx = idx[in_box]
+            idx = idx[points_in_ring(points[idx, :2], ring)]
+        if not len(idx):
+            continue
+        z = points[idx, 2]
+        stats['count'][i] = len(z)
+        stats['z_min'][i] = z.min()
+        stats['z_max'][i] = z.max()
+        stats['z_mean'][i] = z.mean()
+        stats['z_std'][i] = z.std()
+        stats['z_median'][i] = np.median(z)
+        stats['z_sum'][i] = z.sum()
+    return ZoneStats(**stats)
 
 
 def get_point_format(lasfile):
@@ -29,35 +315,45 @@ def get_header(lasfile):
         print(spec.name)
 
 
-def get_nearest(lasfile):
+def get_nearest(las_path):
     """ return a nearest neighbor kdtree query """
 
-    dataset = np.vstack([lasfile.x, lasfile.y, lasfile.z]).transpose()
-    tree = KDTree(dataset)
-    query = tree.query(dataset[100,], k=5)
+    index = LasIndex(las_path)
+    query = index.tree3d.query(index.xyz[100], k=5)
     return query
 
 
-def get_ground_points(lasfile):
-    """ return a numpy array of ground points """
-    
-    num_returns = lasfile.num_returns
-    return_num = lasfile.return_num
-    ground_points = lasfile.points[num_returns == return_num]
-    return ground_points
+def get_ground_points(las_path, chunk_size=CHUNK_SIZE):
+    """ yield the ground point records of each chunk """
+
+    header = read_las_header(las_path)
+    for chunk in iter_las_chunks(las_path, chunk_size):
+        return_num, num_returns = return_numbers(chunk, header)
+        yield chunk[num_returns == return_num]
+
+
+def intensity_counts(las_path, chunk_size=CHUNK_SIZE):
+    """ return the count of every 16 bit intensity value in the file """
+
+    counts = np.zeros(65536, dtype=np.int64)
+    for chunk in iter_las_chunks(las_path, chunk_size):
+        counts += np.bincount(chunk['intensity'], minlength=65536)
+    return counts
 
 
 def main():
     """ Playing around with laspy """
 
-    # input las
-    inFile = File("las/L437_300FT_ROW_TXSP_S_NAD83_2011_USFT.las")
+    import matplotlib.pyplot as plt
 
-    # Grab all of the points from the file.
-    point_records = inFile.points
+    # input las
+    las_path = "las/L437_300FT_ROW_TXSP_S_NAD83_2011_USFT.las"
+    inFile = File(las_path)
+    point_count = read_las_header(las_path)['point_count']
 
     # scale x dimension
-    scaled_x = scaled_x_dimension(inFile)
+    for scaled_x in scaled_x_dimension(las_path):
+        pass
 
     # print point format
     get_point_format(inFile)
@@ -66,16 +362,18 @@ def main():
     get_header(inFile)
 
     # do a nearest neighbor analysis
-    query = get_nearest(inFile)
-    
+    query = get_nearest(las_path)
+
     # get ground points
-    ground_points = get_ground_points(inFile)
-    
-    print("%i points out of %i were ground points." % (len(ground_points),
-                                                       len(inFile)))
+    ground_count = sum(len(ground_points) for ground_points in get_ground_points(las_path))
+
+    print("%i points out of %i were ground points." % (ground_count,
+                                                       point_count))
 
     # plot a map of intensities
-    plt.hist(inFile.intensity)
+    counts = intensity_counts(las_path)
+    values = np.flatnonzero(counts)
+    plt.hist(values, weights=counts[values])
     plt.title("Histogram of the Intensity Dimension")
     plt.show()
 
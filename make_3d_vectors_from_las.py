@@ -6,324 +6,377 @@ import os
 import sys
 import traceback
 import numpy as np
-import Stats as Sts
-from scipy.spatial import KDTree
-from scipy.spatial import distance
-from laspy.file import File
+from las_processing import LasIndex, sample_z_parallel, zonal_stats
 
-#POLYS_2D       = "C:\\JPRATER\\2D_3D Buildings\\3D_Buildings_Z_Attribution\\RAW_BUILDINGS_IDs.shp"
-#BUILDING_LAS   = "C:\\JPRATER\\2D_3D Buildings\\3D_Buildings_Z_Attribution\\las\\SanLuis_61_buildings.las"
-#outFolder      = "C:\\JPRATER\\2D_3D Buildings\\3D_Buildings_Z_Attribution\\output"
+MAX_PASSES = 20 # limit on the passes of each roof correction stage
+# lidar statistics written to each roof part, field name and ZoneStats column
+ZONE_FIELDS = [("COUNT", "count"), ("AREA", "area"), ("MIN", "z_min"), ("MAX", "z_max"), ("RANGE", None),
+               ("MEAN", "z_mean"), ("STD", "z_std"), ("SUM", "z_sum"), ("MEDIAN", "z_median")]
 
-POLYS_2D     = arcpy.GetParameterAsText(0)
-BUILDING_LAS = arcpy.GetParameterAsText(1)
-outFolder    = arcpy.GetParameterAsText(2)
+class RoofParts(object):
+    # packed roof vertices, one buffer for the whole run: part i is
+    # xyz[offsets[i]:offsets[i+1]] (closing vertex included) of building bldg_ids[i].
+    # Parts are views into xyz, so sampling, the corrections and the writers all
+    # see the same vertices
+    def __init__(self, xyz, offsets, bldg_ids):
+        self.xyz = np.ascontiguousarray(xyz, dtype=np.float64).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self.bldg_ids = np.asarray(bldg_ids, dtype=np.int32)
 
-arcpy.env.workspace = outFolder
-arcpy.env.overwriteOutput = True
-arcpy.Delete_management('in_memory')
+    @classmethod
+    def FromFeatures(cls, path, field="BLDG_ID"):
+        # every part of every feature becomes a roof part, Z starts at 0. a roof part
+        # is a single ring, so interior rings (after the None separators in the part's
+        # array) are skipped with a warning rather than run on from the exterior
+        xy = []
+        counts = []
+        bldg_ids = []
+        holes = 0
+        with arcpy.da.SearchCursor(path, ["SHAPE@", field]) as cursor:
+            for row in cursor:
+                for array in row[0]:
+                    pnts = []
+                    ring = 0
+                    for Pnt in array:
+                        if not Pnt:
+                            ring += 1 # an interior ring starts
+                        elif ring == 0:
+                            pnts.append((Pnt.X, Pnt.Y))
+                    holes += ring
+                    xy.extend(pnts)
+                    counts.append(len(pnts))
+                    bldg_ids.append(row[1])
+        if holes:
+            arcpy.AddWarning("    skipped " + str(holes) + " interior roof rings, only exteriors are attributed")
+        offsets = np.zeros(len(counts) + 1, dtype=np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        xyz = np.zeros((len(xy), 3))
+        if xy:
+            xyz[:, :2] = xy
+        return cls(xyz, offsets, bldg_ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def Part(self, i):
+        return self.xyz[self.offsets[i]:self.offsets[i + 1]]
+
+    def Polygon(self, i, sr):
+        return arcpy.Polygon(arcpy.Array([arcpy.Point(*Pnt) for Pnt in self.Part(i).tolist()]), sr, True, True)
+
+def RoofSlopes(xyz, offsets):
+    # % grade of every roof part at once from packed vertices, part i is
+    # xyz[offsets[i]:offsets[i+1]] (closing vertex included). AVG_SLOPE is the slope
+    # of the part's least squares plane, MAX_SLOPE the steeper of that and the
+    # part's steepest edge (a bad vertex shows up as a steep edge on a flat plane)
+    counts = np.diff(offsets)
+    avg_slope = np.zeros(len(counts))
+    max_slope = np.zeros(len(counts))
+    if not len(xyz):
+        return avg_slope, max_slope
+    owner = np.repeat(np.arange(len(counts)), counts)
+
+    # edge slopes, the pairs joining one part to the next aren't edges
+    d = np.diff(xyz, axis=0)
+    run = np.hypot(d[:, 0], d[:, 1])
+    edge = np.abs(d[:, 2]) / np.maximum(run, 1e-9) * 100
+    edge[run == 0] = 0
+    same = owner[:-1] == owner[1:]
+    np.maximum.at(max_slope, owner[:-1][same], edge[same])
+
+    # plane z = a*x + b*y + c per part from the normal equations of the centered
+    # vertices (the closing vertex would count the first one twice)
+    first = xyz[np.minimum(offsets[:-1], len(xyz) - 1)]
+    closed = np.flatnonzero((counts > 3) & np.all(xyz[offsets[1:] - 1] == first, axis=1))
+    weight = np.ones(len(xyz))
+    weight[offsets[closed + 1] - 1] = 0
+    n = np.maximum(np.bincount(owner, weight, len(counts)), 1)
+    centered = [v - (np.bincount(owner, weight * v, len(counts)) / n)[owner] for v in xyz.T]
+
+    def sums(a, b):
+        return np.bincount(owner, weight * a * b, len(counts))
+    sxx = sums(centered[0], centered[0])
+    syy = sums(centered[1], centered[1])
+    sxy = sums(centered[0], centered[1])
+    sxz = sums(centered[0], centered[2])
+    syz = sums(centered[1], centered[2])
+    det = sxx * syy - sxy ** 2
+    ok = det > 1e-12 * np.maximum((sxx + syy) ** 2, 1e-300)
+    a = np.where(ok, sxz * syy - syz * sxy, 0) / np.where(ok, det, 1)
+    b = np.where(ok, syz * sxx - sxz * sxy, 0) / np.where(ok, det, 1)
+    avg_slope = np.hypot(a, b) * 100
+    return avg_slope, np.maximum(max_slope, avg_slope)
+
+def PartRows(offsets, parts):
+    # vertex rows of the given parts back to back, plus their offsets within that selection
+    counts = offsets[parts + 1] - offsets[parts]
+    sub_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=sub_offsets[1:])
+    rows = np.arange(sub_offsets[-1]) - np.repeat(sub_offsets[:-1] - offsets[parts], counts)
+    return rows, sub_offsets
+
+def NearestCandidate(z, samples, rows):
+    # index into each vertex's sorted lidar Z candidates of the one closest to z
+    # (the first on a tie, same as min(enumerate(...)))
+    starts = samples.z_offsets[rows]
+    counts = samples.z_offsets[rows + 1] - starts
+    cols = np.arange(counts.max() if len(rows) else 0)
+    valid = cols < counts[:, None]
+    grid = np.full(valid.shape, np.inf)
+    grid[valid] = samples.z_values[(starts[:, None] + cols)[valid]]
+    return np.argmin(np.abs(grid - z[:, None]), axis=1)
 
-def Query2DLasTree(Pnt):
-    result = tree2D.query_ball_point(Pnt, .5)
-    if len(result) == 0:
-        # if ball query returns nothing use regular query to 
-        # find nearest points and use their avg Z            
-        result = tree2D.query(Pnt, 6)
-        result_z_lst = [round(lasArray3D[i][2],2) for i in result[1]]
-        result_z_lst.sort()
-        result_z_med = Sts.median(result_z_lst)
-        result_z_max = max(result_z_lst)
-        result_z_min = min(result_z_lst)
-        result_z_range = result_z_max - result_z_min 
+def StepRoofZ(xyz, offsets, samples, zone_mean, zone_area, parts, first, second):
+    # one correction pass over the given parts, every vertex at once. the part's
+    # highest vertices step down to the next lower lidar candidate and (first stage)
+    # its lowest ones up to the next higher one, the zone mean stands in when the
+    # candidates run out (a part with no finite mean keeps its Z instead, a vertex
+    # never gets a NaN). returns the number of vertices that moved
+    rows, sub_offsets = PartRows(offsets, parts)
+    if not len(rows):
+        return 0
+    owner = np.repeat(np.arange(len(parts)), np.diff(sub_offsets))
+    starts = sub_offsets[:-1]
+    z = xyz[rows, 2].copy()
+    poly_z_min = np.minimum.reduceat(z, starts)[owner]
+    poly_z_max = np.maximum.reduceat(z, starts)[owner]
+    mean = zone_mean[parts][owner]
+    ranged = samples.z_range[rows] > 1.0
+    first_cand = samples.z_offsets[rows]
+    last_cand = samples.z_offsets[rows + 1] - 1
+
+    if first:
+        # tiny roofs start from the zone mean
+        z = np.where((zone_area[parts][owner] < 10) & (z > mean), mean, z)
+
+    top = np.flatnonzero((z == poly_z_max) & ranged)
+    k = first_cand[top] + NearestCandidate(z[top], samples, rows[top])
+    lower = samples.z_values[np.maximum(k - 1, first_cand[top])]
+    stand_in = np.where(np.isfinite(mean[top]), mean[top], z[top])
+    if second:
+        # the second stage never steps a vertex below the part's lowest
+        z[top] = np.where(k == first_cand[top], stand_in, np.where(lower < poly_z_min[top], z[top], lower))
     else:
-        # if ball query returns points use their median Z
-        result_z_lst = [round(lasArray3D[i][2],2) for i in result]
-        result_z_lst.sort()
-        result_z_med = Sts.median(result_z_lst)
-        result_z_max = max(result_z_lst)
-        result_z_min = min(result_z_lst)
-        result_z_range = result_z_max - result_z_min
-        
-    return [result_z_min, result_z_max, result_z_med, result_z_range, result_z_lst]
+        z[top] = np.where(k == first_cand[top], stand_in, lower)
+        bottom = np.flatnonzero((z == poly_z_min) & ranged)
+        k = first_cand[bottom] + NearestCandidate(z[bottom], samples, rows[bottom])
+        higher = samples.z_values[np.minimum(k + 1, last_cand[bottom])]
+        stand_in = np.where(np.isfinite(mean[bottom]), mean[bottom], z[bottom])
+        z[bottom] = np.where(k == last_cand[bottom], stand_in, higher)
 
-try:
-    arcpy.CheckOutExtension('3D')
-    arcpy.CheckOutExtension("Spatial")
-    
-    sr = arcpy.Describe(POLYS_2D).spatialReference
-    
-    '''make las dataset and compute raster of z_ranges'''
-    # create lasd and raster and stats 
-    LASD = os.path.join(outFolder, "lasd.lasd")
-    arcpy.CreateLasDataset_management(BUILDING_LAS, LASD, "", "", sr, "COMPUTE_STATS")
-    LASD_rstr = os.path.join(outFolder, "lasd_rstr.img")
-    arcpy.LasDatasetToRaster_conversion(LASD, LASD_rstr, "ELEVATION", "BINNING AVERAGE LINEAR", "FLOAT", "CELLSIZE", "0.7", "1")    
+    moved = int(np.count_nonzero(z != xyz[rows, 2]))
+    xyz[rows, 2] = z
+    return moved
+
+def ZoneMeans(zones, samples, offsets):
+    # zone mean of every part for the corrections. a part with no lidar inside its
+    # ring falls back to the median of its vertices' sampled Z candidates (they sit
+    # back to back in z_values). returns the means and the number that fell back
+    means = zones.z_mean.copy()
+    empty = np.flatnonzero(zones.count == 0)
+    for i in empty:
+        candidates = samples.z_values[samples.z_offsets[offsets[i]]:samples.z_offsets[offsets[i + 1]]]
+        if len(candidates):
+            means[i] = np.median(candidates)
+    return means, len(empty)
+
+def CorrectRoofZ(xyz, offsets, samples, zone_mean, zone_area, max_passes=MAX_PASSES):
+    # iterative steep roof solver on packed parts (edited in place), the sorted lidar
+    # Z candidates of every vertex come from one sampling pass up front. stage one
+    # moves the parts over MAX_SLOPE 58 until none are left, stage two eases the high
+    # vertices of parts over 30 while any part is still over 58, only the parts a
+    # pass touched get their slopes recomputed. a stage also stops once a pass moves
+    # nothing. returns the slopes, the changed part mask and (stage, steep parts,
+    # vertices moved) for every pass
+    avg_slope, max_slope = RoofSlopes(xyz, offsets)
+    changed = np.zeros(len(avg_slope), dtype=bool)
+    passes = []
+    for stage, threshold in ((1, 58.0), (2, 30.0)):
+        for i in range(max_passes):
+            if not (max_slope > 58.0).any():
+                break
+            parts = np.flatnonzero(max_slope > threshold)
+            moved = StepRoofZ(xyz, offsets, samples, zone_mean, zone_area, parts, stage == 1 and i == 0, stage == 2)
+            passes.append((stage, len(parts), moved))
+            if not moved:
+                break
+            changed[parts] = True
+            rows, sub_offsets = PartRows(offsets, parts)
+            avg_slope[parts], max_slope[parts] = RoofSlopes(xyz[rows], sub_offsets)
+    return avg_slope, max_slope, changed, passes
+
+def VertexTable(roofs):
+    # one row per roof vertex for Roof_Poly_Points_3D. PNT_ID counts the vertices
+    # of each part and POLY_ID the parts of each building, in the order they come
+    counts = np.diff(roofs.offsets)
+    pnt_id = np.arange(len(roofs.xyz)) - np.repeat(roofs.offsets[:-1], counts)
+    order = np.argsort(roofs.bldg_ids, kind="mergesort")
+    ids = roofs.bldg_ids[order]
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    rank = np.arange(len(ids)) - np.repeat(starts, np.diff(np.r_[starts, len(ids)]))
+    poly_id = np.empty(len(ids), dtype=np.int64)
+    poly_id[order] = rank
+
+    table = np.zeros(len(roofs.xyz), dtype=[("SHAPE_X", "f8"), ("SHAPE_Y", "f8"), ("SHAPE_Z", "f8"),
+                                             ("X", "f8"), ("Y", "f8"), ("Z", "f8"), ("PNT_ID", "i2"),
+                                             ("POLY_ID", "i2"), ("BLDG_ID", "i4")])
+    for axis, name in enumerate("XYZ"):
+        table["SHAPE_" + name] = roofs.xyz[:, axis]
+        table[name] = roofs.xyz[:, axis]
+    table["PNT_ID"] = pnt_id
+    table["POLY_ID"] = np.repeat(poly_id, counts)
+    table["BLDG_ID"] = np.repeat(roofs.bldg_ids, counts)
+    return table
 
-    '''get list of vertices from input polys'''
-    # create list of roof polygon points
-    arcpy.AddMessage("Getting list of 2D roof vertices...")
-    roofPnts = []
-    feaNum = 0
-    for row in arcpy.da.SearchCursor(POLYS_2D, ["SHAPE@", "BLDG_ID"]):
-        # Step into the array of the polygon
-        for array in row[0]:
-            # Step through each point in the array
-            for Pnt in array:
-                x = Pnt.X
-                y = Pnt.Y
-                z = 0.0
-                ID = row[1]
-                # build list of vertices
-                roofPnts.append([x,y,z,feaNum,ID])
-            feaNum += 1 # next line part
-    del row
+def ExportVertices(roofs, path, sr, npz=None):
+    # write every roof vertex to the point shapefile in one call, and the same
+    # columns to an optional .npz sidecar
+    table = VertexTable(roofs)
+    arcpy.da.NumPyArrayToFeatureClass(table, path, ("SHAPE_X", "SHAPE_Y", "SHAPE_Z"), sr)
+    if npz:
+        np.savez_compressed(npz, offsets=roofs.offsets,
+                            **dict((name, table[name]) for name in table.dtype.names if not name.startswith("SHAPE_")))
+    return len(table)
+
+def main():
+    # tool parameters and environment are read here, not at import
+    #POLYS_2D       = "C:\\JPRATER\\2D_3D Buildings\\3D_Buildings_Z_Attribution\\RAW_BUILDINGS_IDs.shp"
+    #BUILDING_LAS   = "C:\\JPRATER\\2D_3D Buildings\\3D_Buildings_Z_Attribution\\las\\SanLuis_61_buildings.las"
+    #outFolder      = "C:\\JPRATER\\2D_3D Buildings\\3D_Buildings_Z_Attribution\\output"
+
+    POLYS_2D     = arcpy.GetParameterAsText(0)
+    BUILDING_LAS = arcpy.GetParameterAsText(1)
+    outFolder    = arcpy.GetParameterAsText(2)
+    WORKERS      = arcpy.GetParameterAsText(3) # optional, number of sampling threads (-1 for all cores)
+    VERTEX_NPZ   = arcpy.GetParameterAsText(4) # optional, .npz copy of the vertex table
+
+    arcpy.env.workspace = outFolder
+    arcpy.env.overwriteOutput = True
+    arcpy.Delete_management('in_memory')
+
+    try:
+        arcpy.CheckOutExtension('3D')
     
-    '''setup numpy arrays and KDTrees of input las'''
-    # read las and make np array of points
-    arcpy.AddMessage("Creating numpy array and KDTrees of LAS...")
-    inFile = File(BUILDING_LAS, mode = "r")
-    lasArray3D = np.vstack([inFile.x, inFile.y, inFile.z]).transpose()
-    lasArray2D = np.vstack([inFile.x, inFile.y]).transpose()
-        
-    # build kd tree2D with lidar
-    tree2D = KDTree(lasArray2D)
-    tree3D = KDTree(lasArray3D)
+        sr = arcpy.Describe(POLYS_2D).spatialReference
+
+        '''get packed vertices from input polys'''
+        arcpy.AddMessage("Getting list of 2D roof vertices...")
+        roofs = RoofParts.FromFeatures(POLYS_2D)
     
-    ''' make initial z assignments '''
-    ''' METHOD: set Pnt.Z to highest z first, then if incorrect, iteratively determine next best low z '''
-    arcpy.AddMessage("Sampling LAS trees...")
-    for Pnt in roofPnts:
-        result = Query2DLasTree(Pnt[:2])
-        z_range = result[3]
-        if z_range > 1.0:
-            Pnt[2] = result[1] # max
-        else:      
-            Pnt[2] = result[2] # med      
+        '''setup numpy arrays and KDTrees of input las'''
+        # read las and make np array of points
+        arcpy.AddMessage("Creating numpy array and KDTree of LAS...")
+        # the 2D tree is built on first use, from the tile's cached points when they're current
+        lasIndex = LasIndex(BUILDING_LAS)
     
-    ''' create shapefile of 3D enabled polygons '''
-    # create 3D polygon
-    arcpy.AddMessage("Creating 3D Buildings...")
+        ''' make initial z assignments '''
+        ''' METHOD: set Pnt.Z to highest z first, then if incorrect, iteratively determine next best low z '''
+        arcpy.AddMessage("Sampling LAS trees...")
+        workers = int(WORKERS) if WORKERS else 1
+        if workers != 1:
+            arcpy.AddMessage("    with " + str(workers) + " threads...")
+        result = sample_z_parallel(lasIndex, roofs.xyz[:, :2], workers)
+        roofs.xyz[:, 2] = np.where(result.z_range > 1.0, result.z_max, result.z_med) # max or med
     
-    Polys3D = os.path.join(outFolder, "Roof_Polys_3D.shp")
-    PolyPnts3D = os.path.join(outFolder, "Roof_Poly_Points_3D.shp")
-    if arcpy.Exists(Polys3D):
-        arcpy.Delete_management(Polys3D)
-    if arcpy.Exists(PolyPnts3D):
-        arcpy.Delete_management(PolyPnts3D)
-    arcpy.CreateFeatureclass_management(outFolder, "Roof_Polys_3D.shp", "POLYGON", "", "ENABLED", "ENABLED", sr)
-    arcpy.AddField_management(Polys3D, "BLDG_ID", "LONG")
+        ''' create shapefile of 3D enabled polygons '''
+        # create 3D polygon
+        arcpy.AddMessage("Creating 3D Buildings...")
     
-    icurs1 = arcpy.da.InsertCursor(Polys3D, ["SHAPE@", "BLDG_ID"])       
-    ID = 0
-    roofPart3D = []
-    for Pnt in roofPnts:
-        # build list of points that makeup the poly
-        if ID == Pnt[3]:
-            roofVertex = arcpy.Point(Pnt[0], Pnt[1], Pnt[2])
-            roofPart3D.append(roofVertex)
-            BLDG_ID = Pnt[4]
-        # make poly geometry and insert into shapefile
-        if ID != Pnt[3]:
-            polygon = arcpy.Polygon(arcpy.Array(roofPart3D), sr, True, True)
-            icurs1.insertRow((polygon, BLDG_ID))
-            ID += 1
-            roofPart3D = []    
-    del icurs1
+        Polys3D = os.path.join(outFolder, "Roof_Polys_3D.shp")
+        PolyPnts3D = os.path.join(outFolder, "Roof_Poly_Points_3D.shp")
+        if arcpy.Exists(Polys3D):
+            arcpy.Delete_management(Polys3D)
+        if arcpy.Exists(PolyPnts3D):
+            arcpy.Delete_management(PolyPnts3D)
+        arcpy.CreateFeatureclass_management(outFolder, "Roof_Polys_3D.shp", "POLYGON", "", "ENABLED", "ENABLED", sr)
+        arcpy.AddField_management(Polys3D, "BLDG_ID", "LONG")
     
-    ''' check for geometry error '''
-    # do stuff to check for quality
-    arcpy.AddMessage("Checking for geometry problems...")
+        # one polygon per roof part, every part written whole
+        partFIDs = []
+        with arcpy.da.InsertCursor(Polys3D, ["SHAPE@", "BLDG_ID"]) as icurs1:
+            for i in range(len(roofs)):
+                partFIDs.append(icurs1.insertRow((roofs.Polygon(i, sr), int(roofs.bldg_ids[i]))))
     
-    geom_table = os.path.join("in_memory", "geom_tbl")
-    arcpy.CheckGeometry_management(Polys3D, geom_table)
-    count = int(arcpy.GetCount_management(geom_table).getOutput(0))
+        ''' check for geometry error '''
+        # do stuff to check for quality
+        arcpy.AddMessage("Checking for geometry problems...")
     
-    if count > 0:
-        arcpy.AddWarning("Found " + str(count) + " geometry issues! Check output table.")
-        arcpy.JoinField_management(Polys3D, "FID", geom_table, "FEATURE_ID")
-    else:
-        arcpy.AddMessage("    No geometry problems found!")
+        geom_table = os.path.join("in_memory", "geom_tbl")
+        arcpy.CheckGeometry_management(Polys3D, geom_table)
+        count = int(arcpy.GetCount_management(geom_table).getOutput(0))
     
-    ''' add polygon geometry attributes to the polygon shapefile '''
-    # add slope values to each roof plane (avg slope is % grade)
-    arcpy.AddMessage("Calculating roof slopes...")    
+        if count > 0:
+            arcpy.AddWarning("Found " + str(count) + " geometry issues! Check output table.")
+            arcpy.JoinField_management(Polys3D, "FID", geom_table, "FEATURE_ID")
+        else:
+            arcpy.AddMessage("    No geometry problems found!")
     
-    ######### need to substitute this with custom gradient/slope calculation code #############
-    arcpy.AddZInformation_3d(Polys3D, ["AVG_SLOPE", "MAX_SLOPE"])
-    #####################################################################################
+        ''' add polygon geometry attributes to the polygon shapefile '''
+        # add slope values to each roof plane (avg slope is % grade)
+        arcpy.AddMessage("Calculating roof slopes...")    
+        arcpy.AddField_management(Polys3D, "AVG_SLOPE", "DOUBLE")
+        arcpy.AddField_management(Polys3D, "MAX_SLOPE", "DOUBLE")
     
-    ''' add input las raster attributes to the polygon shapefile '''
-    arcpy.AddMessage("Correcting bad roof planes...")
-    LASD_tbl = os.path.join(outFolder, "lasd_tbl.dbf")
-    arcpy.gp.ZonalStatisticsAsTable_sa(Polys3D, "FID", LASD_rstr, LASD_tbl, "NODATA", "ALL")
-    # add fields ["FID_", "COUNT", "AREA", "MIN", "MAX", "RANGE", "MEAN", "STD", "SUM"]
-    arcpy.JoinField_management(Polys3D, "FID", LASD_tbl, "FID_")
+        for field, column in ZONE_FIELDS:
+            arcpy.AddField_management(Polys3D, field, "LONG" if field == "COUNT" else "DOUBLE")
     
-    ''' if slope is steep, determine next best vertex elevation by analyzing average elevations of las inside polygon '''
-    arcpy.MakeFeatureLayer_management(Polys3D, "polys3d_lyr")
-    arcpy.SelectLayerByAttribute_management("polys3d_lyr", "NEW_SELECTION", '"MAX_SLOPE" > 58.0')
-    count = int(arcpy.GetCount_management("polys3d_lyr").getOutput(0))
+        # the corrections run on the packed roof vertices and slopes are recomputed
+        # in memory, only the final parts get written back
     
-    terminator = 0
-    while count != 0:
-        if terminator == 20:
-            break
-        with arcpy.da.UpdateCursor(Polys3D, ["SHAPE@", "Max_Slope", "MEAN", "AREA"]) as cursor:
-            for row in cursor:
-                if row[1] > 58.0:#if polygon has a very steep point/part
-                    for array in row[0]:
-                        poly_z_lst = [Pnt.Z for Pnt in array] # make list of point geometry z's
-                        poly_z_min = min(poly_z_lst) # get min z
-                        poly_z_max = max(poly_z_lst) # get max z
-                        poly_z_avg = sum(poly_z_lst)/len(poly_z_lst)
-                        roofPart3D = []
-                        for Pnt in array:
-                            XY = (Pnt.X, Pnt.Y)
-                            result = Query2DLasTree(XY)
-                            result_z_lst = result[4]
-                            result_z_range = result[3]
-                            result_z_med = result[2]
-                            result_z_max = result[1]
-                            result_z_min = result[0]   
-                            
-                            if terminator == 0 and row[3] < 10 and Pnt.Z > row[2]:
-                                Pnt.Z = row[2]
-                                                
-                            if Pnt.Z == poly_z_max:
-                                if result_z_range > 1.0:
-                                    lst_query = min(enumerate(result_z_lst), key=lambda x: abs(x[1]-Pnt.Z))
-                                    if lst_query[0] != 0:
-                                        next_z = lst_query[0] - 1
-                                        Pnt.Z = result_z_lst[next_z]
-                                    else:
-                                        Pnt.Z = row[2]
-                            if Pnt.Z == poly_z_min:
-                                if result_z_range > 1.0:
-                                    lst_query = min(enumerate(result_z_lst), key=lambda x: abs(x[1]-Pnt.Z))
-                                    if lst_query[0] != len(result_z_lst)-1:
-                                        next_z = lst_query[0] + 1
-                                        Pnt.Z = result_z_lst[next_z]
-                                    else:
-                                        Pnt.Z = row[2]
-                                
-                            # need to rebuild polygon geometry object
-                            roofVertex = arcpy.Point(Pnt.X, Pnt.Y, Pnt.Z)                        
-                            roofPart3D.append(roofVertex)
-                        polygon = arcpy.Polygon(arcpy.Array(roofPart3D), sr, True, True)
-                        row[0] = polygon
-                        cursor.updateRow(row)                                
+        ''' add input las attributes to the polygon shapefile '''
+        # lidar points are assigned straight to the roof parts, no lasd raster or zonal table
+        arcpy.AddMessage("Correcting bad roof planes...")
+        zones = zonal_stats(lasIndex, roofs.xyz[:, :2], roofs.offsets)
+        zoneValues = [zones.z_max - zones.z_min if column is None else getattr(zones, column)
+                      for field, column in ZONE_FIELDS]
     
-        # recalculate polygon geometry                
-        arcpy.DeleteField_management(Polys3D, "AVG_SLOPE")
-        arcpy.DeleteField_management(Polys3D, "MAX_SLOPE")
-        arcpy.AddZInformation_3d(Polys3D, ["AVG_SLOPE", "MAX_SLOPE"])
+        ''' if slope is steep, determine next best vertex elevation by analyzing average elevations of las inside polygon '''
+        # the vertices never move in XY, so the first sampling's candidates are reused
+        zoneMean, empty = ZoneMeans(zones, result, roofs.offsets)
+        if empty:
+            arcpy.AddWarning("    " + str(empty) + " roof parts have no lidar inside, using their vertex samples")
+        avgSlope, maxSlope, changed, passes = CorrectRoofZ(roofs.xyz, roofs.offsets, result,
+                                                           zoneMean, zones.area)
+        for stage, steep, moved in passes:
+            arcpy.AddMessage("    stage " + str(stage) + ": " + str(steep) + " steep roof parts, " +
+                             str(moved) + " vertices moved")
+        arcpy.AddMessage("    " + str(int((maxSlope > 58.0).sum())) + " roof parts still over 58% after " +
+                         str(len(passes)) + " passes")
         
-        arcpy.MakeFeatureLayer_management(Polys3D, "polys3d_lyr")
-        arcpy.SelectLayerByAttribute_management("polys3d_lyr", "NEW_SELECTION", '"MAX_SLOPE" > 58.0')
-        count = int(arcpy.GetCount_management("polys3d_lyr").getOutput(0))        
-
-        terminator += 1
-
-    arcpy.MakeFeatureLayer_management(Polys3D, "polys3d_lyr")
-    arcpy.SelectLayerByAttribute_management("polys3d_lyr", "NEW_SELECTION", '"MAX_SLOPE" > 58.0')
-    count = int(arcpy.GetCount_management("polys3d_lyr").getOutput(0))    
-    terminator = 0
-    while count != 0:
-        if terminator == 20:
-            break
-        with arcpy.da.UpdateCursor(Polys3D, ["SHAPE@", "Max_Slope", "MEAN"]) as cursor:
+        # write the corrected parts, their slopes and lidar stats back in one pass,
+        # parts with no lidar inside get null stats
+        partIndex = dict((fid, i) for i, fid in enumerate(partFIDs))
+        fields = ["OID@", "SHAPE@", "AVG_SLOPE", "MAX_SLOPE"] + [field for field, column in ZONE_FIELDS]
+        with arcpy.da.UpdateCursor(Polys3D, fields) as cursor:
             for row in cursor:
-                if row[1] > 30.0:#if polygon has a very steep point/part
-                    for array in row[0]:
-                        poly_z_lst = [Pnt.Z for Pnt in array] # make list of point geometry z's
-                        poly_z_min = min(poly_z_lst) # get min z
-                        poly_z_max = max(poly_z_lst) # get max z
-                        poly_z_avg = sum(poly_z_lst)/len(poly_z_lst)
-                        roofPart3D = []
-                        for Pnt in array:
-                            XY = (Pnt.X, Pnt.Y)
-                            result = Query2DLasTree(XY)
-                            result_z_lst = result[4]
-                            result_z_range = result[3]
-                            result_z_med = result[2]
-                            result_z_max = result[1]
-                            result_z_min = result[0] 
-                                                
-                            if Pnt.Z == poly_z_max:
-                                if result_z_range > 1.0:
-                                    lst_query = min(enumerate(result_z_lst), key=lambda x: abs(x[1]-Pnt.Z))
-                                    if lst_query[0] != 0:
-                                        next_z = lst_query[0] - 1
-                                        if result_z_lst[next_z] < poly_z_min:
-                                            pass
-                                        else:
-                                            Pnt.Z = result_z_lst[next_z]
-                                    else:
-                                        Pnt.Z = row[2]
-                                
-                            # need to rebuild polygon geometry object
-                            roofVertex = arcpy.Point(Pnt.X, Pnt.Y, Pnt.Z)                        
-                            roofPart3D.append(roofVertex)
-                        polygon = arcpy.Polygon(arcpy.Array(roofPart3D), sr, True, True)
-                        row[0] = polygon
-                        cursor.updateRow(row)                                
-    
-        # recalculate polygon geometry                
-        arcpy.DeleteField_management(Polys3D, "AVG_SLOPE")
-        arcpy.DeleteField_management(Polys3D, "MAX_SLOPE")
-        arcpy.AddZInformation_3d(Polys3D, ["AVG_SLOPE", "MAX_SLOPE"])
-        
-        arcpy.MakeFeatureLayer_management(Polys3D, "polys3d_lyr")
-        arcpy.SelectLayerByAttribute_management("polys3d_lyr", "NEW_SELECTION", '"MAX_SLOPE" > 58.0')
-        count = int(arcpy.GetCount_management("polys3d_lyr").getOutput(0))        
-
-        terminator += 1                                
-        
-    # recalculate polygon geometry                
-    arcpy.DeleteField_management(Polys3D, "AVG_SLOPE")
-    arcpy.DeleteField_management(Polys3D, "MAX_SLOPE")
-    arcpy.AddZInformation_3d(Polys3D, ["AVG_SLOPE", "MAX_SLOPE"])   
+                i = partIndex[row[0]]
+                if changed[i]:
+                    row[1] = roofs.Polygon(i, sr)
+                row[2] = float(avgSlope[i])
+                row[3] = float(maxSlope[i])
+                for j, values in enumerate(zoneValues):
+                    value = values[i].item()
+                    row[4 + j] = None if value != value else value
+                cursor.updateRow(row)
             
-    arcpy.AddMessage("Creating polygon vertex shapefile...")
-    arcpy.CreateFeatureclass_management(outFolder, "Roof_Poly_Points_3D.shp", "POINT", "", "ENABLED", "ENABLED", sr)
-    arcpy.AddField_management(PolyPnts3D, "X", "DOUBLE")
-    arcpy.AddField_management(PolyPnts3D, "Y", "DOUBLE")
-    arcpy.AddField_management(PolyPnts3D, "Z", "DOUBLE")
-    arcpy.AddField_management(PolyPnts3D, "PNT_ID", "SHORT")
-    arcpy.AddField_management(PolyPnts3D, "POLY_ID", "SHORT")
-    arcpy.AddField_management(PolyPnts3D, "BLDG_ID", "LONG")
-
-    icurs2 = arcpy.da.InsertCursor(PolyPnts3D, ["SHAPE@", "X", "Y", "Z", "PNT_ID", "POLY_ID", "BLDG_ID"])
-    
-    BLDG_ID = []
-    poly_id = 0    
-    with arcpy.da.SearchCursor(Polys3D, ["SHAPE@", "BLDG_ID"]) as cursor:
-        for row in cursor:
-            pnt_id = 0
-            if row[1] not in BLDG_ID:
-                BLDG_ID.append(row[1])
-                poly_id = 0
-            else:
-                poly_id += 1
-            for array in row[0]:
-                for Pnt in array:
-                    icurs2.insertRow((arcpy.Point(Pnt.X, Pnt.Y, Pnt.Z), Pnt.X, Pnt.Y, Pnt.Z, pnt_id, poly_id, row[1]))
-                    pnt_id += 1
-    del icurs2
+        arcpy.AddMessage("Creating polygon vertex shapefile...")
+        count = ExportVertices(roofs, PolyPnts3D, sr, VERTEX_NPZ)
+        arcpy.AddMessage("    " + str(count) + " vertices written")
             
-    #clean up
-    arcpy.DeleteField_management(Polys3D, "Id")
-    arcpy.DeleteField_management(PolyPnts3D, "Id")
-    #arcpy.Delete_management(LASD)
-    #arcpy.Delete_management(LASD_rstr)
-    #arcpy.Delete_management(LASD_tbl)
-    arcpy.AddMessage("Done!")
+        #clean up
+        arcpy.DeleteField_management(Polys3D, "Id")
+        if arcpy.ListFields(PolyPnts3D, "Id"):
+            arcpy.DeleteField_management(PolyPnts3D, "Id")
+        arcpy.AddMessage("Done!")
     
-except Exception as e:
-    tb = sys.exc_info()[2]
-    tbinfo = traceback.format_tb(tb)[0]   
-    arcpy.AddError("\nTraceback info:\n" + tbinfo)
-    arcpy.AddError(e.message)
-    arcpy.Delete_management('in_memory')
-    sys.exit()
+    except Exception as e:
+        tb = sys.exc_info()[2]
+        tbinfo = traceback.format_tb(tb)[0]   
+        arcpy.AddError("\nTraceback info:\n" + tbinfo)
+        arcpy.AddError(e.message)
+        arcpy.Delete_management('in_memory')
+        sys.exit()
+
 
+if __name__ == '__main__':
+    main()
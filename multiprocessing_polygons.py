@@ -9,6 +9,10 @@ import scipy
 from scipy import interpolate
 import multiprocessing
 import datetime
+from shapely import wkb
+from shapely.geometry import Polygon
+from polygon_tools import CleanPolys, RepairPolys, FindDuplicates, ParallelErasePolys, BufferPolys, FeatureAreas, \
+    FilterAreas, SQFT_PER_SQM, JOIN_STYLES
 
 arcpy.Delete_management("in_memory")
 arcpy.env.overwriteOutput = True
@@ -18,156 +22,348 @@ CLIP_SHP = arcpy.GetParameterAsText(1) #Feature Layer
 OUT_FOLDER = arcpy.GetParameterAsText(2) # fodler
 CIRCUIT = arcpy.GetParameterAsText(3) #Circuit Name
 COORD = arcpy.GetParameterAsText(4) #Coordinate system
+SMOOTH_TOL = arcpy.GetParameterAsText(5) #optional, max distance (ft) a smoothed edge may stray from the spline
+NATIVE_REPAIR = arcpy.GetParameterAsText(6) #optional boolean, repair and dissolve in memory
+PIPELINE = arcpy.GetParameterAsText(7) #optional boolean, run every stage in memory and only write the final polys
+CHECKPOINTS = arcpy.GetParameterAsText(8) #optional, pipeline stages to also write out, e.g. "smooth,buffer"
+BUFFER_JOIN = arcpy.GetParameterAsText(9) #optional, pipeline buffer joins: ROUND (default, as Buffer_analysis), MITRE or BEVEL
+BUFFER_SEGMENTS = arcpy.GetParameterAsText(10) #optional, pipeline segments per quarter circle of round joins
 
+MIN_AREA = 4356 # sqft (1/10 acre), smaller IVM polys are dropped
+BUFFER_FT = 0.25 # outward buffer of the dissolved smoothed polys
+QUAD_SEGMENTS = 16 # default segments per quarter circle of round buffer joins
+BATCH_VERTICES = 5000 # rough number of vertices sent to a worker at a time
+SMOOTH_SAMPLES = 250 # vertices per smoothed ring without a tolerance
+MIN_SAMPLES = 16 # adaptive sample count limits
+MAX_SAMPLES = 5000
 
-def SmoothPolys(BuffPolyCoords):
+# shapefile each pipeline stage is checkpointed to
+CHECKPOINT_NAMES = {"repair": "POLYS_Dissolve.shp",
+                    "smooth": "ALL_Smoothed_Polys.shp",
+                    "buffer": "ALL_IVM_POLYS.shp",
+                    "erase": "ALL_IVM_POLYS_Erase.shp"}
+
+
+def AdaptiveSamples(tck, vertices, tolerance):
     
-    # to ensure a smooth start/end of the smoothed polygon, need to copy first 
-    # few coord pairs (after initial) to end of list
-    pair1 = BuffPolyCoords[1]
-    pair2 = BuffPolyCoords[2]
-    pair3 = BuffPolyCoords[3]
-
-    BuffPolyCoords.append(pair1)
-    BuffPolyCoords.append(pair2)
-    BuffPolyCoords.append(pair3)
-
-    # divide the list of XY pairs into separate list of X and Y
-    Xlist, Ylist = zip(*BuffPolyCoords)
-
-    # convert those lists to arrays
-    x = numpy.array(Xlist)
-    y = numpy.array(Ylist)
-
-    ''' here is the smoothing routine - using a b-spline that passes through each original polygon vertex
-        the interpolate function will make a poly with at least 500 vertices (less results in jagged edges, 
-        while more just slows process WAAAAY down without much improvement)'''
+    # spline parameters to sample so no chord strays more than tolerance from the curve.
+    # a chord c across a bend of radius r bulges c^2/8r off it, so the curve needs
+    # sqrt(curvature / (8 * tolerance)) samples per unit length - integrate that along
+    # the spline and place the samples at equal steps of it (few on the straights,
+    # many in the bends)
+    probe = numpy.linspace(0, 1, 8 * vertices + 1)
+    dx, dy = scipy.interpolate.splev(probe, tck, der=1)
+    ddx, ddy = scipy.interpolate.splev(probe, tck, der=2)
+    speed = numpy.maximum(numpy.hypot(dx, dy), 1e-12)
+    curvature = numpy.abs(dx * ddy - dy * ddx) / speed ** 3
+    density = numpy.maximum(numpy.sqrt(curvature / (8.0 * tolerance)) * speed, 1e-9)
+    cumulative = numpy.concatenate([[0.0], numpy.cumsum((density[1:] + density[:-1]) / 2 * numpy.diff(probe))])
+    count = int(min(max(numpy.ceil(cumulative[-1]) + 1, MIN_SAMPLES), MAX_SAMPLES))
+    u = numpy.interp(numpy.linspace(0, cumulative[-1], count), cumulative, probe)
+
+    # the bulge estimate misses s-bends and tight turns, so split any span that
+    # still strays from its chord by more than tolerance at its quarter points
+    for _ in range(8):
+        x, y = scipy.interpolate.splev(u, tck)
+        cx, cy = numpy.diff(x), numpy.diff(y)
+        chord = numpy.maximum(numpy.hypot(cx, cy), 1e-12)
+        off = numpy.zeros(len(chord))
+        for t in (.25, .5, .75):
+            px, py = scipy.interpolate.splev(u[:-1] + t * numpy.diff(u), tck)
+            off = numpy.maximum(off, numpy.abs((px - x[:-1]) * cy - (py - y[:-1]) * cx) / chord)
+        split = off > tolerance
+        if not split.any() or len(u) + split.sum() > MAX_SAMPLES:
+            break
+        u = numpy.sort(numpy.concatenate([u, (u[1:] + u[:-1])[split] / 2]))
+    return u
+
+
+def SmoothTolerance(sr):
     
-    # this is necessary to prepare the data for the spline 
-    # (smoothing is zero and k=2 is best smoothing polynomial (k3 would be cubic and is too much))
-    tck, u = scipy.interpolate.splprep([x,y],s=0.0,k=2) 
-    #this performs the spline, it makes a new smoothed polygon with at least 500 vertices
-    x2, y2 = scipy.interpolate.splev(numpy.linspace(0,1,250),tck)  
+    # SMOOTH_TOL is given in feet, the splines are sampled in the data's coordinate units
+    return float(SMOOTH_TOL) * 0.3048 / sr.metersPerUnit if SMOOTH_TOL else None
+
+
+def SmoothPolys(coords, offsets, samples=SMOOTH_SAMPLES, tolerance=None):
+    
+    # smooth many rings at once - coords is an (n, 2) array of every ring's vertices
+    # back to back, ring i is coords[offsets[i]:offsets[i+1]]. the smoothed rings
+    # come back packed the same way. with a tolerance the number of samples is
+    # picked per ring from its length and curvature, otherwise every ring gets samples
+    u = numpy.linspace(0, 1, samples)
+    smoothed = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        ring = coords[start:end]
+        if len(ring) < 4:
+            smoothed.append(ring)
+            continue
+
+        # to ensure a smooth start/end of the smoothed polygon, need to copy first 
+        # few coord pairs (after initial) to end of the ring
+        ring = numpy.concatenate([ring, ring[1:4]])
+
+        ''' here is the smoothing routine - using a b-spline that passes through each original polygon vertex
+            (smoothing is zero and k=2 is best smoothing polynomial (k3 would be cubic and is too much)) '''
+        tck, params = scipy.interpolate.splprep([ring[:, 0], ring[:, 1]], s=0.0, k=2)
+        if tolerance:
+            u = AdaptiveSamples(tck, len(ring), tolerance)
+        x2, y2 = scipy.interpolate.splev(u, tck)
+
+        # the spline starts with a copy of the first 3 segments - cut it back to the
+        # smoothed point closest to the 3rd vertex, by direct distance. the copied
+        # tail ends exactly on that vertex, so only look before the closing vertex
+        dist = (x2 - ring[3, 0]) ** 2 + (y2 - ring[3, 1]) ** 2
+        dist[u >= params[-4]] = numpy.inf
+        start = numpy.argmin(dist)
+        smoothed.append(numpy.column_stack([x2[start:], y2[start:]]))
 
-    # now we have the x2 and y2 so we zip the arrays together to create coordinate pairs
-    SmoothedCoords = list(zip(x2,y2))
+    smoothed_offsets = numpy.zeros(len(smoothed) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(ring) for ring in smoothed], out=smoothed_offsets[1:])
+    if not smoothed:
+        return numpy.empty((0, 2)), smoothed_offsets
+    return numpy.concatenate(smoothed), smoothed_offsets
 
-    # get the nearest 3 points to the pair3 coordinate - 
-    #these will be candidates to stop removing points of the initial 3 segments
-    KDT_pts = scipy.spatial.cKDTree(numpy.array(SmoothedCoords))
 
-    # Find the nearest 2 points to the pair3 and get those values for comparison while deleting first segs in list
-    nearQuery = KDT_pts.query((pair3[0],pair3[1]),k=2)
+def ReadRings(polys):
     
-    # this is the index of the points nearest pair3
-    WatchIndices = nearQuery[1] 
+    # pull every ring out of the feature class once as an (n, 2) coordinate array
+    rings = []
+    with arcpy.da.SearchCursor(polys, ["Shape@"]) as cursor:
+        for row in cursor:
+            for array in row[0]:
+                rings.append(numpy.array([(pnt.X, pnt.Y) for pnt in array if pnt is not None]))
+    return rings
+
+
+def ReadGeoms(polys, fields, sr=None):
+    
+    # shapely geometries of every non null shape (in sr if given) plus their field values
+    geoms = []
+    rows = []
+    with arcpy.da.SearchCursor(polys, ["SHAPE@WKB"] + fields, spatial_reference=sr) as cursor:
+        for row in cursor:
+            if row[0]:
+                geoms.append(wkb.loads(bytes(row[0])))
+                rows.append(row[1:])
+    return geoms, rows
 
-    minimumIndex = min(WatchIndices)
+
+def WriteGeoms(path, geoms, sr, fields=(), rows=None):
     
-    # this is going to delete all index pairs from 0 to specified watch point
-    del SmoothedCoords[0:minimumIndex] 
+    # write shapely polys to a new feature class in one insert pass, fields are
+    # (name, type) pairs and rows their values per poly
+    arcpy.CreateFeatureclass_management(os.path.dirname(path), os.path.basename(path), "POLYGON", "", "", "", sr)
+    for name, field_type in fields:
+        arcpy.AddField_management(path, name, field_type)
+    with arcpy.da.InsertCursor(path, ["SHAPE@WKB"] + [name for name, _ in fields]) as icurs:
+        for i, geom in enumerate(geoms):
+            icurs.insertRow([bytearray(geom.wkb)] + (list(rows[i]) if rows else []))
+
+
+def ProjectGeoms(geoms, sr, out_sr):
     
-    # polygon boundary coordinates - can be used to make a new geometry and add to shapefile output
-    return SmoothedCoords 
+    # shapely geometries in sr -> the same geometries in out_sr. they go through an
+    # in_memory copy in one insert pass and come back projected by the read cursor,
+    # no per geometry arcpy calls. IDX puts them back in order (null shapes come
+    # back empty)
+    path = os.path.join("in_memory", "Project_Geoms")
+    WriteGeoms(path, geoms, sr, [("IDX", "LONG")], [(i,) for i in range(len(geoms))])
+    projected = [Polygon()] * len(geoms)
+    for geom, row in zip(*ReadGeoms(path, ["IDX"], out_sr)):
+        projected[row[0]] = geom
+    arcpy.Delete_management(path)
+    return projected
+
+
+def PolyRings(polys):
     
+    # the ring of each shapely poly the way ReadRings hands it over
+    # (holes run on from their exterior as one ring)
+    rings = []
+    for poly in polys:
+        parts = [poly.exterior] + list(poly.interiors)
+        rings.append(numpy.concatenate([numpy.asarray(part.coords)[:, :2] for part in parts]))
+    return rings
+
+
+def SplitRings(polys):
     
-def MakePolys(job):
+    # every ring of the shapely polys on its own (exterior, then holes) plus the ring
+    # offsets of each poly, so the rings can be smoothed separately and put back
+    rings = []
+    offsets = [0]
+    for poly in polys:
+        for part in [poly.exterior] + list(poly.interiors):
+            rings.append(numpy.asarray(part.coords)[:, :2])
+        offsets.append(len(rings))
+    return rings, offsets
+
+
+def JoinRings(rings, offsets):
     
-    # get unique feature name
-    path = os.path.dirname(job)
-    name = os.path.basename(job).strip('.shp') + "_SMOOTHED"
-    lyr_name = os.path.basename(job).strip('.shp')
+    # shapely polys back from their smoothed rings, holes too small to be a ring are
+    # dropped and so is a poly whose exterior is
+    polys = []
+    for first, last in zip(offsets[:-1], offsets[1:]):
+        if len(rings[first]) >= 3:
+            polys.append(Polygon(rings[first], [rings[i] for i in range(first + 1, last) if len(rings[i]) >= 3]))
+    return polys
+
+
+def RepairRings(polys):
     
-    # make feature layer in mem
-    arcpy.MakeFeatureLayer_management(job, lyr_name)
+    # in memory repair and dissolve by HANDLE: repair the polys, drop duplicates and
+    # union the ones sharing a HANDLE, then hand back their rings
+    geoms, rows = ReadGeoms(polys, ["HANDLE"])
+    return PolyRings(CleanPolys(geoms, [row[0] for row in rows])[0])
+
+
+def PackRings(rings):
     
-    # create smooth polygons feature class
-    COORD = arcpy.Describe(job).spatialReference
-    POLYS_SMOOTH = os.path.join("in_memory", name)
-    arcpy.CreateFeatureclass_management("in_memory", name, "POLYGON", "", "", "", COORD)
-    icurs = arcpy.da.InsertCursor(POLYS_SMOOTH, ["Shape@", "OID"])
-    for field in arcpy.ListFields(POLYS_SMOOTH):
-        print field.name
-        
-    with arcpy.da.SearchCursor(lyr_name, ["Shape@"]) as cursor:
-        for i, row in enumerate(cursor):
-            poly = row[0]
-            for array in poly:
-                BuffPolyCoords = [] # BuffPolyCoords are the polygon boundary coordinates ((x1,y1),(x2,y,)(x3,y3)....)
-                for pnt in array:
-                    if pnt is not None:
-                        x = pnt.X
-                        y = pnt.Y
-                        BuffPolyCoords.append((x,y))
-                newPolyCoords = SmoothPolys(BuffPolyCoords) # call smoothing routine
-                # create arcpy geometry for new polygon
-                newPoly = arcpy.Polygon(arcpy.Array(arcpy.Point(item[0], item[1]) for item in newPolyCoords)) 
-                icurs.insertRow((newPoly, i)) # insert geometry into feature class
-    del icurs    
-    SMOOTHED_POLYS = os.path.join(OUT_FOLDER, name + ".shp")
-    arcpy.CopyFeatures_management(POLYS_SMOOTH, SMOOTHED_POLYS)
-    #return POLYS_SMOOTH
-    return SMOOTHED_POLYS
-
-
-def ParsePolys(polys, cpus, FC_per_cpu):
+    # list of (n, 2) rings -> one coordinate array plus ring offsets
+    offsets = numpy.zeros(len(rings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(ring) for ring in rings], out=offsets[1:])
+    if not rings:
+        return numpy.empty((0, 2)), offsets
+    return numpy.concatenate(rings), offsets
+
+
+def BatchRings(rings, batch_vertices):
     
-    name = os.path.basename(polys).strip('.shp')
-    # PARSE POLYGONS INTO EQUAL(ish) layers FOR MULTIPROCESSING (must be on disk)?
-    jobs_list = []
-    for i, cpu in enumerate(range(cpus)):
-        # feature layer name
-        job_name = name + "_job_" + str(cpu) + ".lyr"
-        
-        # disk path
-        job = os.path.join(OUT_FOLDER, job_name.replace('.lyr', '.shp'))
-        print job_name
-        
-        if i == 0:
-            # job1
-            rangeI = FC_per_cpu
-            print "0 - " + str(rangeI)
-            arcpy.MakeFeatureLayer_management(polys, job_name, ' "FID" <= ' + str(rangeI))
-            arcpy.CopyFeatures_management(job_name, job)
-            lyr_count = int(arcpy.GetCount_management(job).getOutput(0))
-            #print job + ": " + str(lyr_count)
-            #print os.path.abspath(job)
-            jobs_list.append(job)
-        else:
-            # jobN...
-            rangeJ = rangeI + FC_per_cpu
-            print str(rangeI) + " - " + str(rangeJ)
-            arcpy.MakeFeatureLayer_management(polys, job_name, ' "FID" > ' + str(rangeI) + ' AND "FID" <= ' + str(rangeJ))
-            arcpy.CopyFeatures_management(job_name, job)
-            lyr_count = int(arcpy.GetCount_management(job).getOutput(0))
-            #print job + ": " + str(lyr_count)
-            #print os.path.abspath(job)
-            jobs_list.append(job)
-            rangeI = rangeJ
-            #print rangeI
-            rangeJ += FC_per_cpu
-            #print rangeJ
-            
-    print "\n"
-    return jobs_list
+    # longest rings first so the slowest work starts first, packed into batches
+    # of roughly batch_vertices vertices each (a big ring is a batch on its own)
+    order = sorted(range(len(rings)), key=lambda i: len(rings[i]), reverse=True)
+    batch = []
+    batch_size = 0
+    for i in order:
+        batch.append(i)
+        batch_size += len(rings[i])
+        if batch_size >= batch_vertices:
+            yield (batch,) + PackRings([rings[j] for j in batch])
+            batch = []
+            batch_size = 0
+    if batch:
+        yield (batch,) + PackRings([rings[j] for j in batch])
 
 
-def main():
-    print str(datetime.datetime.now())
-    # NEW 1-27-16: adding a repair geometry step to fix polys from microstation.  
-    # Must delete those with null value or else ends up dropping polygons in the final result.
-    arcpy.AddMessage("\nChecking/Repairing possible topology errors...")
-    REPAIRED = os.path.join("in_memory", "POLYS_Repaired")
-    arcpy.CopyFeatures_management(POLYS, REPAIRED) # make copy of original
-    arcpy.RepairGeometry_management(REPAIRED, "DELETE_NULL") 
+def SmoothBatch(batch):
     
-    # prep polys for smoothing
-    arcpy.AddMessage("Dissolving PRE IVM Polys by 'HANDLE' with no 'Multifeatures'...")
-    POLYS_DISS = os.path.join("in_memory", "POLYS_Dissolve")
-    arcpy.Dissolve_management(REPAIRED, POLYS_DISS, "HANDLE", "", "SINGLE_PART") 
+    # worker: smooth a packed batch of rings and hand back the ring ids with the result
+    ids, coords, offsets, tolerance = batch
+    return (ids,) + SmoothPolys(coords, offsets, tolerance=tolerance)
+
+
+def SmoothRings(rings, tolerance, cpus):
     
-    # get count of polygons
-    FC_Count = int(arcpy.GetCount_management(POLYS_DISS).getOutput(0))
+    # smooth every ring over a pool of cpus workers, the smoothed coordinate arrays
+    # come back in the rings' order. small batches handed out as workers free up
+    # keep every core busy to the end
+    jobs = (batch + (tolerance,) for batch in BatchRings(rings, BATCH_VERTICES))
+    pool = multiprocessing.Pool(processes=cpus)
+    smoothed = [None] * len(rings)
+    for ids, coords, offsets in pool.imap_unordered(SmoothBatch, jobs):
+        for j, i in enumerate(ids):
+            smoothed[i] = coords[offsets[j]:offsets[j + 1]]
+    pool.close()
+    pool.join()
+    return smoothed
+
+
+def RunPipeline():
+    
+    # the whole tool in memory: repair/dissolve -> smooth -> dissolve + buffer -> erase ->
+    # area filter -> duplicates, with the polys handed from stage to stage as shapely
+    # geometry and coordinate arrays. the final polys are the only write unless
+    # stages are named in CHECKPOINTS
+    COORD = arcpy.Describe(POLYS).spatialReference
+    checkpoints = [stage.strip().lower() for stage in str(CHECKPOINTS).split(",") if stage.strip()]
+    cpus = max(multiprocessing.cpu_count() - 1, 1)
+    tolerance = SmoothTolerance(COORD)
+
+    def checkpoint(stage, polys):
+        if stage in checkpoints:
+            path = os.path.join(OUT_FOLDER, CHECKPOINT_NAMES[stage])
+            arcpy.AddMessage("\tCheckpoint: " + path)
+            WriteGeoms(path, polys, COORD)
+
+    arcpy.AddMessage("\nRepairing and dissolving PRE IVM Polys by 'HANDLE' in memory...")
+    geoms, rows = ReadGeoms(POLYS, ["HANDLE"])
+    polys = CleanPolys(geoms, [row[0] for row in rows])[0]
+    checkpoint("repair", polys)
+
+    arcpy.AddMessage("Smoothing " + str(len(polys)) + " Polygons with " + str(cpus) + " cores...")
+    arcpy.AddMessage("\tStarted: " + str(datetime.datetime.now()))
+    # exteriors and holes are smoothed as separate rings, then rebuilt into their polys
+    rings, offsets = SplitRings(polys)
+    polys = JoinRings(SmoothRings(rings, tolerance, cpus), offsets)
+    arcpy.AddMessage("\tFinished: " + str(datetime.datetime.now()))
+    checkpoint("smooth", polys)
+
+    # dissolve and buffer in one pass - touching buffers merge as each batch is buffered.
+    # round joins by default like Buffer_analysis, mitre ones keep the spline vertex counts
+    # where round ones multiply them
+    arcpy.AddMessage("Dissolving and buffering smoothed polys by .25ft...")
+    distance = BUFFER_FT * 0.3048 / COORD.metersPerUnit
+    join_style = JOIN_STYLES[str(BUFFER_JOIN).upper() if BUFFER_JOIN else "ROUND"]
+    segments = int(BUFFER_SEGMENTS) if BUFFER_SEGMENTS else QUAD_SEGMENTS
+    polys = BufferPolys(RepairPolys(polys)[0], distance, cpus, segments, join_style, dissolve=True)
+    checkpoint("buffer", polys)
+
+    arcpy.AddMessage("Erasing veg polygon overlays from IVM candidates...")
+    clip_polys = RepairPolys(ReadGeoms(CLIP_SHP, [], COORD)[0])[0]
+    polys = [geom for geom in ParallelErasePolys(polys, clip_polys, cpus) if not geom.is_empty]
+    checkpoint("erase", polys)
+
+    arcpy.AddMessage("Removing polys with less than 4356 sqft (1/10 acre)...")
+    GCS = COORD.GCS
+    areas = FeatureAreas(ProjectGeoms(polys, COORD, GCS), (GCS.semiMajorAxis, GCS.flattening)) * SQFT_PER_SQM
+    keep, ids = FilterAreas(areas, MIN_AREA)
+    arcpy.AddMessage("\t" + str(len(polys) - len(keep)) + " polys removed!")
+
+    duplicates = set(FindDuplicates([polys[i] for i in keep]))
+    arcpy.AddMessage("\t" + str(len(duplicates)) + " duplicate polys removed!")
+    final = [j for j in range(len(keep)) if j not in duplicates]
+
+    FINAL_SHP = os.path.join(OUT_FOLDER, CIRCUIT + "_FINAL_STEP1_IVM_POLYGONS.shp")
+    WriteGeoms(FINAL_SHP, [polys[keep[j]] for j in final], COORD, [("IVM_ID", "LONG"), ("AREA_SQFT", "DOUBLE")],
+               [(int(ids[j]), float(areas[keep[j]])) for j in final])
+    arcpy.AddMessage("Final output: " + str(os.path.abspath(FINAL_SHP)))
+
+
+def main():
+    print str(datetime.datetime.now())
+    if str(PIPELINE).lower() == 'true':
+        RunPipeline()
+        arcpy.AddMessage("Done!\n")
+        print str(datetime.datetime.now())
+        return
+
+    if str(NATIVE_REPAIR).lower() == 'true':
+        # same repair and dissolve as below, without the tool calls or the in_memory copies
+        arcpy.AddMessage("\nRepairing and dissolving PRE IVM Polys by 'HANDLE' in memory...")
+        COORD = arcpy.Describe(POLYS).spatialReference
+        rings = RepairRings(POLYS)
+        FC_Count = len(rings)
+    else:
+        # NEW 1-27-16: adding a repair geometry step to fix polys from microstation.  
+        # Must delete those with null value or else ends up dropping polygons in the final result.
+        arcpy.AddMessage("\nChecking/Repairing possible topology errors...")
+        REPAIRED = os.path.join("in_memory", "POLYS_Repaired")
+        arcpy.CopyFeatures_management(POLYS, REPAIRED) # make copy of original
+        arcpy.RepairGeometry_management(REPAIRED, "DELETE_NULL") 
+        
+        # prep polys for smoothing
+        arcpy.AddMessage("Dissolving PRE IVM Polys by 'HANDLE' with no 'Multifeatures'...")
+        POLYS_DISS = os.path.join("in_memory", "POLYS_Dissolve")
+        arcpy.Dissolve_management(REPAIRED, POLYS_DISS, "HANDLE", "", "SINGLE_PART") 
+        
+        # get count of polygons
+        FC_Count = int(arcpy.GetCount_management(POLYS_DISS).getOutput(0))
+        
+        # read the rings into memory, they go to the workers as coordinate arrays
+        arcpy.AddMessage("Reading PRE IVM Polys...")
+        COORD = arcpy.Describe(POLYS_DISS).spatialReference
+        rings = ReadRings(POLYS_DISS)
     print "\nFC_Count: " + str(FC_Count)
     
     # get number of cpus in machine
@@ -175,44 +371,35 @@ def main():
     cpus = int(multiprocessing.cpu_count()-1) # let's not be greedy
     print "cpus: " + str(cpus)
     
-    # get count of polys per cpu
-    total = (FC_Count/cpus) 
-    print "FC_Count/cpus: " + str(total)
-    
-    # account for possible odd number
-    remainder = FC_Count%cpus
-    FC_per_cpu = total+remainder # always make them non float and make sure we dont leave any out
-    print "remainder: " + str(remainder)
-    print "FC_per_cpu: " + str(FC_per_cpu) + "\n"
-    
-    # parse polys for multiprocessing
-    arcpy.AddMessage("Parsing PRE IVM Polys...")
-    parsed_polys = ParsePolys(POLYS_DISS, cpus, FC_per_cpu)
-    
     # BEGIN SMOOTHING 
     arcpy.AddMessage("Smoothing " + str(FC_Count) + " Polygons with " + str(cpus) + " of " + str(max_cpus) + 
                      " cores... hold on to your butts")
     arcpy.AddMessage("\tStarted: " + str(datetime.datetime.now()))
 
     # CREATE A POOL CLASS AND RUN THE JOBS
-    pool = multiprocessing.Pool(processes=cpus)
-    smoothed_polys = pool.map(MakePolys, parsed_polys)
-    pool.close()
-    pool.join()
+    tolerance = SmoothTolerance(COORD)
+    smoothed = SmoothRings(rings, tolerance, cpus)
     
     arcpy.AddMessage("\tFinished: " + str(datetime.datetime.now()))
+    if tolerance:
+        # rings under 4 vertices pass through unsmoothed, only count the resampled ones.
+        # the fixed mode's seam trimming cuts its rings below SMOOTH_SAMPLES, so that
+        # count is only a nominal upper bound
+        resampled = [i for i, ring in enumerate(rings) if len(ring) >= 4]
+        vertices = sum(len(smoothed[i]) for i in resampled)
+        nominal = len(resampled) * SMOOTH_SAMPLES
+        arcpy.AddMessage("\t" + str(vertices) + " smoothed vertices within " + str(SMOOTH_TOL) + "ft, vs " +
+                         str(nominal) + " nominal (" + str(SMOOTH_SAMPLES) + " per ring before seam trimming)")
 
-    # merge pooled polys back together
+    # write the smoothed polys in their original order
     POLYS_SMOOTH = os.path.join(OUT_FOLDER, "ALL_Smoothed_Polys.shp")
-    arcpy.Merge_management(smoothed_polys, POLYS_SMOOTH)
+    arcpy.CreateFeatureclass_management(OUT_FOLDER, "ALL_Smoothed_Polys.shp", "POLYGON", "", "", "", COORD)
+    icurs = arcpy.da.InsertCursor(POLYS_SMOOTH, ["Shape@"])
+    for coords in smoothed:
+        icurs.insertRow((arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in coords]), COORD),))
+    del icurs
 
     # CLEANUP
-    for shp in smoothed_polys:
-        arcpy.Delete_management(shp)
-    
-    for shp in parsed_polys:
-        arcpy.Delete_management(shp)    
-
     arcpy.Delete_management("in_memory")
     
     # dissolve
@@ -234,41 +421,54 @@ def main():
     arcpy.AddMessage("Done with ETGeoWizard...")
     arcpy.AddMessage("Calculating area...")
     
-    # ID info
+    # ID info and new field (AREA_SQFT)
     arcpy.AddField_management(FINAL_SHP, "IVM_ID", "LONG")
-    count = 1
-    with arcpy.da.UpdateCursor(FINAL_SHP, ["IVM_ID"]) as cursor:
-        for row in cursor:
-            row[0] = count
-            count += 1
-            cursor.updateRow(row)
-    
-    # Add new field (AREA_SQFT) 
     arcpy.AddField_management(FINAL_SHP, "AREA_SQFT", "DOUBLE")
     
     arcpy.AddMessage("Removing polys with less than 4356 sqft (1/10 acre)...")
-    # update new field and remove polys less than 4356 ft^2
-    count = 0
-    with arcpy.da.UpdateCursor(FINAL_SHP, ["Shape@", "AREA_SQFT"]) as cursor:
+    # geodesic areas of every poly at once, on the ellipsoid of the data's datum -
+    # the cursor hands the shapes back in that datum's geographic coordinates
+    GCS = arcpy.Describe(FINAL_SHP).spatialReference.GCS
+    ellipsoid = (GCS.semiMajorAxis, GCS.flattening)
+    oids = []
+    geoms = []
+    with arcpy.da.SearchCursor(FINAL_SHP, ["OID@", "SHAPE@WKB"], spatial_reference=GCS) as cursor:
         for row in cursor:
-            poly = row[0]
-            area = poly.getArea("GEODESIC", "SQUAREFEET")
-            if area <= 4356:
-                count += 1
-                cursor.deleteRow()
-            else:
-                row[1] = area
-                cursor.updateRow(row)
-    arcpy.AddMessage("\t" + str(count) + " polys removed!")
+            oids.append(row[0])
+            geoms.append(wkb.loads(bytes(row[1])) if row[1] else Polygon())
+    areas = FeatureAreas(geoms, ellipsoid) * SQFT_PER_SQM
+    keep, ids = FilterAreas(areas, MIN_AREA)
+    kept = dict((oids[i], (int(ivm_id), areas[i])) for i, ivm_id in zip(keep, ids))
     
-    # Delete shapes with duplicate geometry: (added 2-11-16)
-    TrackGeometries = []
-    with arcpy.da.UpdateCursor(FINAL_SHP, ["SHAPE@XY"]) as cursor:
+    # number, size and drop the small polys in one pass (IDs keep the dropped polys' gaps)
+    with arcpy.da.UpdateCursor(FINAL_SHP, ["OID@", "IVM_ID", "AREA_SQFT"]) as cursor:
         for row in cursor:
-            if row[0] not in TrackGeometries:
-                TrackGeometries.append(row[0])
+            if row[0] in kept:
+                row[1], row[2] = kept[row[0]]
+                cursor.updateRow(row)
             else:
                 cursor.deleteRow()
+    arcpy.AddMessage("\t" + str(len(oids) - len(kept)) + " polys removed!")
+    
+    # Delete shapes with duplicate geometry: (added 2-11-16)
+    # shapes are hashed on centroid and vertex count, only the ones that collide get
+    # compared (area, then full geometry), so this stays linear in the poly count
+    oids = []
+    geoms = []
+    with arcpy.da.SearchCursor(FINAL_SHP, ["OID@", "SHAPE@WKB"]) as cursor:
+        for row in cursor:
+            if row[1]:
+                geom = wkb.loads(bytes(row[1]))
+                if not geom.is_empty:
+                    oids.append(row[0])
+                    geoms.append(geom)
+    duplicates = set(oids[i] for i in FindDuplicates(geoms))
+    if duplicates:
+        with arcpy.da.UpdateCursor(FINAL_SHP, ["OID@"]) as cursor:
+            for row in cursor:
+                if row[0] in duplicates:
+                    cursor.deleteRow()
+    arcpy.AddMessage("\t" + str(len(duplicates)) + " duplicate polys removed!")
     
     arcpy.Delete_management("in_memory")
     arcpy.AddMessage("Final output: " + str(os.path.abspath(FINAL_SHP)))
@@ -0,0 +1,554 @@
+# Geometry routines shared by the IVM polygon scripts (multipolygons.py,
+# multiprocessing_polygons.py). Nothing in here touches arcpy, so worker
+# processes only need numpy and shapely to import it.
+
+import datetime
+import multiprocessing
+from collections import OrderedDict
+import os
+import struct
+import numpy as np
+from shapely import wkb
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+try:
+    # shapely 2 builds whole arrays of geometries at once
+    from shapely import from_ragged_array, to_ragged_array, is_valid, GeometryType
+except ImportError:
+    from_ragged_array = to_ragged_array = None
+
+try:
+    # shapely 1.8+, keeps every lobe of a bow tie where buffer(0) drops one
+    from shapely.validation import make_valid
+except ImportError:
+    make_valid = None
+
+# shapefile polygon shape types: Polygon, PolygonZ, PolygonM
+POLYGON_TYPES = (5, 15, 25)
+
+# records assembled in memory before each write to the .shp
+WRITE_BLOCK = 10000
+
+# centroid grid (coordinate units) exact duplicates are hashed on
+DUPLICATE_GRID = 0.01
+
+# semi major axis (m) and flattening of GRS80, the NAD83 ellipsoid
+GRS80 = (6378137.0, 1 / 298.257222101)
+
+SQFT_PER_SQM = 1 / 0.3048 ** 2
+
+# buffer join styles by name, as shapely numbers them
+JOIN_STYLES = {'ROUND': 1, 'MITRE': 2, 'BEVEL': 3}
+
+
+def ReadPolyArrays(shp_path):
+    """ Read the polygon records of a shapefile straight into arrays: coords
+    (n, 2), ring_offsets (ring i is coords[ring_offsets[i]:ring_offsets[i+1]],
+    closing vertex included) and the record number of each ring. Record
+    headers are located through the .shx, null shapes are skipped and a file
+    with no polygon records gives empty arrays. """
+
+    with open(os.path.splitext(shp_path)[0] + '.shx', 'rb') as f:
+        index = np.frombuffer(f.read()[100:], dtype='>i4').reshape(-1, 2)
+    if not len(index):
+        return np.empty((0, 2)), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+    data = np.memmap(shp_path, dtype=np.uint8, mode='r')
+    content = index[:, 0].astype(np.int64) * 2 + 8
+
+    def ints(pos):
+        # little endian int32 at each byte position
+        return np.ascontiguousarray(data[pos[:, None] + np.arange(4)]).view('<i4').ravel()
+
+    shape_types = ints(content)
+    records = np.flatnonzero(np.any([shape_types == t for t in POLYGON_TYPES], axis=0))
+    if not len(records):
+        return np.empty((0, 2)), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+    content = content[records]
+    num_parts = ints(content + 36).astype(np.int64)
+    num_points = ints(content + 40).astype(np.int64)
+
+    # every part start, shifted from record relative to global
+    point_base = np.zeros(len(records) + 1, dtype=np.int64)
+    np.cumsum(num_points, out=point_base[1:])
+    point_base = point_base[:-1]
+    part_base = np.zeros(len(records) + 1, dtype=np.int64)
+    np.cumsum(num_parts, out=part_base[1:])
+    part_base = part_base[:-1]
+    part_rank = np.arange(num_parts.sum()) - np.repeat(part_base, num_parts)
+    part_starts = ints(np.repeat(content + 44, num_parts) + 4 * part_rank) + np.repeat(point_base, num_parts)
+
+    coords = np.empty((num_points.sum(), 2))
+    first_point = content + 44 + 4 * num_parts
+    for pos, base, count in zip(first_point, point_base, num_points):
+        coords[base:base + count] = np.frombuffer(data, '<f8', 2 * count, pos).reshape(count, 2)
+
+    ring_offsets = np.append(part_starts, len(coords))
+    return coords, ring_offsets, np.repeat(records, num_parts)
+
+
+def SumRingEdges(edges, ring_offsets):
+    """ Sum a per edge value (edge i runs from vertex i to i+1 of the packed
+    coords) over every ring, skipping the pairs that join one ring to the next
+    (edges is modified in place). """
+
+    if not len(edges):
+        return np.zeros(len(ring_offsets) - 1)
+    edges[ring_offsets[1:-1] - 1] = 0
+    starts = np.minimum(ring_offsets[:-1], len(edges) - 1)
+    sums = np.add.reduceat(edges, starts)
+    sums[np.diff(ring_offsets) < 2] = 0
+    return sums
+
+
+def SignedRingAreas(coords, ring_offsets):
+    """ Shoelace area of every closed ring at once, negative when clockwise
+    (a shapefile exterior), positive when counter clockwise (a hole). """
+
+    cross = coords[:-1, 0] * coords[1:, 1] - coords[1:, 0] * coords[:-1, 1]
+    return SumRingEdges(cross, ring_offsets) / 2.0
+
+
+def ConvertPolys(shp_path):
+    """ Build shapely polygons from a polygon shapefile in bulk. Clockwise rings
+    start a new polygon, counter clockwise rings are holes of the polygon before
+    them (a record's first ring is always an exterior). Only polygons that come
+    out invalid get repaired, through RepairPolys so a bow tie keeps both lobes
+    (as separate polygons). """
+
+    coords, ring_offsets, ring_records = ReadPolyArrays(shp_path)
+    first_ring = np.ones(len(ring_records), dtype=bool)
+    first_ring[1:] = ring_records[1:] != ring_records[:-1]
+    exterior = first_ring | (SignedRingAreas(coords, ring_offsets) < 0)
+    poly_offsets = np.append(np.flatnonzero(exterior), len(exterior))
+
+    if from_ragged_array is not None:
+        polys = from_ragged_array(GeometryType.POLYGON, coords, (ring_offsets, poly_offsets))
+        invalid = np.flatnonzero(~is_valid(polys))
+        polys = list(polys)
+    else:
+        polys = []
+        for first, last in zip(poly_offsets[:-1], poly_offsets[1:]):
+            rings = [coords[ring_offsets[i]:ring_offsets[i + 1]] for i in range(first, last)]
+            polys.append(Polygon(rings[0], rings[1:]))
+        invalid = [i for i, poly in enumerate(polys) if not poly.is_valid]
+
+    if len(invalid):
+        fixed, positions = RepairPolys([polys[i] for i in invalid])
+        # polygons that repair to nothing are dropped, the rest split into their parts
+        parts = dict((i, []) for i in invalid)
+        parts.update((invalid[j], ExplodePolys([geom])) for geom, j in zip(fixed, positions))
+        polys = [part for i, poly in enumerate(polys) for part in parts.get(i, [poly])]
+    return polys
+
+
+def PackPolys(polys):
+    """ Ring coordinate arrays of a list of Polygons, taken straight from the
+    geometries: coords (n, 2), ring_offsets and poly_offsets (polygon i is rings
+    poly_offsets[i] to poly_offsets[i+1], its exterior first). """
+
+    if not len(polys):
+        return np.empty((0, 2)), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    if to_ragged_array is not None:
+        _, coords, (ring_offsets, poly_offsets) = to_ragged_array(polys)
+        return coords, ring_offsets.astype(np.int64), poly_offsets.astype(np.int64)
+
+    rings = []
+    poly_sizes = []
+    for poly in polys:
+        rings.append(np.asarray(poly.exterior.coords)[:, :2])
+        rings.extend(np.asarray(ring.coords)[:, :2] for ring in poly.interiors)
+        poly_sizes.append(len(poly.interiors) + 1)
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(ring) for ring in rings], out=ring_offsets[1:])
+    poly_offsets = np.zeros(len(polys) + 1, dtype=np.int64)
+    np.cumsum(poly_sizes, out=poly_offsets[1:])
+    return np.concatenate(rings), ring_offsets, poly_offsets
+
+
+def OrientRings(coords, ring_offsets, poly_offsets):
+    """ Reverse rings as needed so exteriors run clockwise and holes counter
+    clockwise, as shapefiles expect. Returns the reordered coords. """
+
+    exterior = np.zeros(len(ring_offsets) - 1, dtype=bool)
+    exterior[poly_offsets[:-1]] = True
+    areas = SignedRingAreas(coords, ring_offsets)
+    flip = (exterior & (areas > 0)) | (~exterior & (areas < 0))
+    if not flip.any():
+        return coords
+
+    lengths = np.diff(ring_offsets)
+    ring = np.repeat(np.arange(len(lengths)), lengths)
+    order = np.arange(len(coords))
+    mirrored = ring_offsets[:-1][ring] + ring_offsets[1:][ring] - 1 - order
+    return coords[np.where(flip[ring], mirrored, order)]
+
+
+def WritePolys(shp_path, coords, ring_offsets, poly_offsets, ids=None):
+    """ Write packed polygons to a polygon shapefile (.shp, .shx and a .dbf with
+    a numeric ID field). Rings are oriented first, record headers, parts and
+    bounding boxes are computed for all polygons at once and records go to
+    disk WRITE_BLOCK at a time. """
+
+    coords = OrientRings(coords, ring_offsets, poly_offsets)
+    count = len(poly_offsets) - 1
+    ids = np.zeros(count, dtype=np.int64) if ids is None else np.asarray(ids)
+
+    num_parts = np.diff(poly_offsets)
+    first_point = ring_offsets[poly_offsets]
+    num_points = np.diff(first_point)
+    content_words = (44 + 4 * num_parts + 16 * num_points) // 2
+    record_offsets = 50 + np.cumsum(content_words + 4) - (content_words + 4)
+    file_words = 50 + int((content_words + 4).sum())
+
+    if count:
+        starts = first_point[:-1]
+        boxes = np.column_stack([np.minimum.reduceat(coords[:, 0], starts),
+                                 np.minimum.reduceat(coords[:, 1], starts),
+                                 np.maximum.reduceat(coords[:, 0], starts),
+                                 np.maximum.reduceat(coords[:, 1], starts)])
+        extent = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+    else:
+        boxes = np.zeros((0, 4))
+        extent = (0.0, 0.0, 0.0, 0.0)
+
+    def header(words):
+        return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, words) + struct.pack('<2i', 1000, 5) +
+                struct.pack('<8d', *(extent + (0.0, 0.0, 0.0, 0.0))))
+
+    base = os.path.splitext(shp_path)[0]
+    with open(base + '.shp', 'wb') as shp:
+        shp.write(header(file_words))
+        block = []
+        for i in range(count):
+            parts = ring_offsets[poly_offsets[i]:poly_offsets[i + 1]] - first_point[i]
+            block.append(struct.pack('>2i', i + 1, int(content_words[i])) +
+                         struct.pack('<i4d2i', 5, *(tuple(boxes[i]) + (int(num_parts[i]), int(num_points[i])))) +
+                         parts.astype('<i4').tobytes() +
+                         coords[first_point[i]:first_point[i + 1]].astype('<f8').tobytes())
+            if len(block) == WRITE_BLOCK:
+                shp.write(b''.join(block))
+                block = []
+        shp.write(b''.join(block))
+
+    with open(base + '.shx', 'wb') as shx:
+        shx.write(header(50 + 4 * count))
+        shx.write(np.column_stack([record_offsets, content_words]).astype('>i4').tobytes())
+
+    # dBASE III table, one numeric ID column
+    today = datetime.date.today()
+    with open(base + '.dbf', 'wb') as dbf:
+        dbf.write(struct.pack('<4BI2H20x', 3, today.year - 1900, today.month, today.day, count, 65, 11))
+        dbf.write(struct.pack('<11sc4x2B14x', b'ID', b'N', 10, 0) + b'\r')
+        dbf.write(b''.join(b' %10d' % value for value in ids.astype(np.int64).tolist()) + b'\x1a')
+
+
+def BuildIndex(geoms):
+    """ STRtree over geoms plus a query function returning the indices of the
+    geometries whose envelopes hit a geometry (shapely 1.x trees hand back the
+    geometries themselves, 2.x their indices). """
+
+    tree = STRtree(geoms)
+    positions = dict((id(geom), i) for i, geom in enumerate(geoms))
+
+    def query(geom):
+        hits = tree.query(geom)
+        if len(hits) and hasattr(hits[0], 'geom_type'):
+            return sorted(positions[id(hit)] for hit in hits)
+        return sorted(int(hit) for hit in hits)
+    return query
+
+
+def ErasePolys(polys, erase_polys):
+    """ Subtract erase_polys from each polygon in polys. Only the erase polygons
+    that actually intersect a polygon are subtracted from it: candidates come
+    from an STRtree and are confirmed against the prepared polygon. Returns
+    one geometry per input polygon, in order (empty if fully erased). """
+
+    if not len(erase_polys):
+        return list(polys)
+    query = BuildIndex(erase_polys)
+
+    erased = []
+    for poly in polys:
+        prepared = prep(poly)
+        hits = [erase_polys[i] for i in query(poly) if prepared.intersects(erase_polys[i])]
+        if not hits:
+            erased.append(poly)
+        elif len(hits) == 1:
+            erased.append(poly.difference(hits[0]))
+        else:
+            erased.append(poly.difference(unary_union(hits)))
+    return erased
+
+
+def ZOrder(geoms, bits=16):
+    """ Order geometries along a Z-order (Morton) curve through their envelope
+    centers, so runs of the result are spatially coherent. """
+
+    if not len(geoms):
+        return np.zeros(0, dtype=np.intp)
+    bounds = np.array([geom.bounds for geom in geoms])
+    centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+    low = centers.min(axis=0)
+    span = np.maximum(centers.max(axis=0) - low, 1e-12)
+    cells = ((centers - low) / span * (2 ** bits - 1)).astype(np.uint64)
+    codes = np.zeros(len(geoms), dtype=np.uint64)
+    for bit in range(bits):
+        for dim in range(2):
+            codes |= ((cells[:, dim] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + dim)
+    return np.argsort(codes, kind='mergesort')
+
+
+def EraseBatch(job):
+    """ worker: erase a batch of polygons, WKB in and out """
+
+    polys = [wkb.loads(geom) for geom in job[0]]
+    erase_polys = [wkb.loads(geom) for geom in job[1]]
+    return [geom.wkb for geom in ErasePolys(polys, erase_polys)]
+
+
+def ParallelErasePolys(polys, erase_polys, workers=1, batch_size=500):
+    """ ErasePolys over a process pool. Polygons are cut into spatially
+    coherent batches along a Z-order curve and each batch only carries the
+    erase polygons that can touch it, all as WKB. Results come back in input
+    order whatever the worker count. """
+
+    if workers < 2 or len(polys) <= batch_size or not len(erase_polys):
+        return ErasePolys(polys, erase_polys)
+    query = BuildIndex(erase_polys)
+    order = ZOrder(polys)
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+    def jobs():
+        for batch in batches:
+            candidates = sorted(set(i for j in batch for i in query(polys[j])))
+            yield ([polys[j].wkb for j in batch], [erase_polys[i].wkb for i in candidates])
+
+    erased = [None] * len(polys)
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        for batch, result in zip(batches, pool.imap(EraseBatch, jobs())):
+            for j, geom in zip(batch, result):
+                erased[j] = wkb.loads(geom)
+    finally:
+        pool.close()
+        pool.join()
+    return erased
+
+
+def ExplodePolys(geoms):
+    """ Flatten Polygons, MultiPolygons and collections into a list of
+    non-empty Polygons, dropping anything that isn't polygonal. """
+
+    polys = []
+    for geom in geoms:
+        if geom.is_empty:
+            continue
+        if geom.geom_type == 'Polygon':
+            polys.append(geom)
+        elif hasattr(geom, 'geoms'):
+            polys.extend(ExplodePolys(geom.geoms))
+    return polys
+
+
+def RepairPolys(geoms):
+    """ Make every geometry valid and polygonal, the in memory version of
+    RepairGeometry with DELETE_NULL. Returns the repaired geometries and the
+    input position of each, null and empty ones (or ones that repair to
+    nothing polygonal) are dropped. """
+
+    kept = [i for i, geom in enumerate(geoms) if geom is not None and not geom.is_empty]
+    repaired = [geoms[i] for i in kept]
+    if from_ragged_array is not None and repaired:
+        invalid = np.flatnonzero(~is_valid(repaired))
+    else:
+        invalid = [i for i, geom in enumerate(repaired) if not geom.is_valid]
+
+    for i in invalid:
+        geom = make_valid(repaired[i]) if make_valid is not None else repaired[i].buffer(0)
+        parts = ExplodePolys([geom])
+        repaired[i] = parts[0] if len(parts) == 1 else MultiPolygon(parts) if parts else None
+    return ([geom for geom in repaired if geom is not None],
+            [i for i, geom in zip(kept, repaired) if geom is not None])
+
+
+def Fingerprints(polys):
+    """ centroid (n, 2), area, perimeter and vertex count of each geometry """
+
+    centers = np.array([poly.centroid.coords[0] for poly in polys]).reshape(-1, 2)
+    areas = np.array([poly.area for poly in polys])
+    lengths = np.array([poly.length for poly in polys])
+    counts = np.array([sum(len(ring.coords) for part in ExplodePolys([poly])
+                           for ring in [part.exterior] + list(part.interiors)) for poly in polys],
+                      dtype=np.int64)
+    return centers, areas, lengths, counts
+
+
+def FindDuplicates(polys, tolerance=0.0, keys=None):
+    """ Positions of the polygons that repeat an earlier one (with the same key,
+    when keys are given). Polygons are hashed on their centroid snapped to a
+    grid, so only those in the same or a neighbouring cell are ever compared
+    and the whole pass is linear. Without a tolerance a duplicate must match
+    in vertex count and area and be geometrically equal, with one anything
+    within tolerance (Hausdorff distance) is a near duplicate. """
+
+    if not len(polys):
+        return []
+    keys = [None] * len(polys) if keys is None else keys
+    centers, areas, lengths, counts = Fingerprints(polys)
+    cells = np.floor(centers / (tolerance if tolerance > 0 else DUPLICATE_GRID)).astype(np.int64)
+
+    def same(i, j):
+        if tolerance > 0:
+            return (abs(areas[i] - areas[j]) <= tolerance * max(lengths[i], lengths[j]) and
+                    polys[i].hausdorff_distance(polys[j]) <= tolerance)
+        return abs(areas[i] - areas[j]) <= 1e-9 * max(areas[i], 1.0) and polys[i].equals(polys[j])
+
+    buckets = {}
+    duplicates = []
+    for i, (x, y) in enumerate(cells.tolist()):
+        # exact duplicates share a vertex count, near ones needn't
+        count = int(counts[i]) if tolerance <= 0 else None
+        neighbours = [(keys[i], count, x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+        if any(same(i, j) for cell in neighbours for j in buckets.get(cell, ())):
+            duplicates.append(i)
+        else:
+            buckets.setdefault((keys[i], count, x, y), []).append(i)
+    return duplicates
+
+
+def DissolvePolys(polys, keys=None):
+    """ Cascaded union of the polygons sharing a key (all of them without keys),
+    split into single part polygons like Dissolve with SINGLE_PART. Returns
+    the polygons and the key of each, groups in the order their key first
+    appears. """
+
+    keys = [None] * len(polys) if keys is None else keys
+    groups = OrderedDict()
+    for poly, key in zip(polys, keys):
+        groups.setdefault(key, []).append(poly)
+
+    dissolved = []
+    dissolved_keys = []
+    for key, group in groups.items():
+        parts = ExplodePolys([group[0] if len(group) == 1 else unary_union(group)])
+        dissolved.extend(parts)
+        dissolved_keys.extend([key] * len(parts))
+    return dissolved, dissolved_keys
+
+
+def CleanPolys(polys, keys=None):
+    """ Repair, drop duplicates and dissolve by key in one go, standing in for
+    the RepairGeometry / DeleteIdentical / Dissolve tool chain without any
+    intermediate feature classes. Only exact duplicates are dropped, anything
+    else is left for the union to merge. Returns single part polygons and
+    their keys. """
+
+    keys = [None] * len(polys) if keys is None else keys
+    repaired, kept = RepairPolys(polys)
+    keys = [keys[i] for i in kept]
+    duplicates = set(FindDuplicates(repaired, 0.0, keys))
+    unique = [i for i in range(len(repaired)) if i not in duplicates]
+    return DissolvePolys([repaired[i] for i in unique], [keys[i] for i in unique])
+
+
+def GeodesicAreas(coords, ring_offsets, poly_offsets, ellipsoid=GRS80):
+    """ Ellipsoidal area (square metres) of packed polygons whose coords are
+    longitude, latitude degrees. Latitudes are taken to authalic latitudes and
+    each edge adds the spherical trapezoid between it and the equator on the
+    sphere of equal area, so every ring is a few array operations whatever
+    its size. Holes subtract from their polygon. """
+
+    a, f = ellipsoid
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(coords[:, 1])
+    if f:
+        e2 = f * (2 - f)
+        e = np.sqrt(e2)
+
+        def q(sin_lat):
+            return (1 - e2) * (sin_lat / (1 - e2 * sin_lat ** 2) -
+                               np.log((1 - e * sin_lat) / (1 + e * sin_lat)) / (2 * e))
+        qp = q(1.0)
+        lat = np.arcsin(np.clip(q(np.sin(lat)) / qp, -1, 1))
+        radius2 = a * a * qp / 2
+    else:
+        radius2 = a * a
+
+    t = np.tan(lat / 2)
+    dlon = (np.diff(lon) + np.pi) % (2 * np.pi) - np.pi
+    excess = 2 * np.arctan(np.tan(dlon / 2) * (t[:-1] + t[1:]) / (1 + t[:-1] * t[1:]))
+    rings = np.abs(SumRingEdges(excess, ring_offsets)) * radius2
+
+    hole = np.ones(len(rings), dtype=bool)
+    hole[poly_offsets[:-1]] = False
+    rings[hole] *= -1
+    if not len(rings):
+        return np.zeros(len(poly_offsets) - 1)
+    areas = np.add.reduceat(rings, np.minimum(poly_offsets[:-1], len(rings) - 1))
+    areas[np.diff(poly_offsets) == 0] = 0
+    return areas
+
+
+def FeatureAreas(geoms, ellipsoid=GRS80):
+    """ GeodesicAreas of a list of longitude, latitude geometries, multipart
+    ones summed over their parts (0 for empty or non-polygonal geometries). """
+
+    parts = [ExplodePolys([geom]) for geom in geoms]
+    owners = np.repeat(np.arange(len(geoms)), [len(part) for part in parts])
+    coords, ring_offsets, poly_offsets = PackPolys([poly for part in parts for poly in part])
+    areas = GeodesicAreas(coords, ring_offsets, poly_offsets, ellipsoid)
+    return np.bincount(owners, weights=areas, minlength=len(geoms))
+
+
+def FilterAreas(areas, min_area):
+    """ Sliver filter: the positions of the polygons larger than min_area and
+    their 1 based ids, numbered over every polygon so ids keep the gaps
+    left by the dropped ones. """
+
+    keep = np.flatnonzero(np.asarray(areas) > min_area)
+    return keep, keep + 1
+
+
+def BufferBatch(job):
+    """ worker: buffer a batch of WKB polygons, unioned into one when dissolving """
+
+    geoms, distance, resolution, join_style, dissolve = job
+    buffered = [wkb.loads(geom).buffer(distance, resolution, join_style=join_style) for geom in geoms]
+    if dissolve:
+        buffered = [unary_union(buffered)]
+    return [geom.wkb for geom in buffered]
+
+
+def BufferPolys(polys, distance, workers=1, resolution=16, join_style=1, dissolve=False, batch_size=500):
+    """ Buffer polygons over a process pool in spatially coherent (Z-order)
+    batches. resolution is the segments per quarter circle of round joins,
+    mitre or bevel joins add no vertices at all. With dissolve each batch
+    unions its buffers as it goes and the batches are unioned at the end,
+    so overlapping buffers merge in the same pass and single part polygons
+    come back, otherwise one buffer per input in input order. """
+
+    order = ZOrder(polys)
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    jobs = (([polys[j].wkb for j in batch], distance, resolution, join_style, dissolve) for batch in batches)
+
+    if workers < 2 or len(batches) < 2:
+        results = [BufferBatch(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            results = list(pool.imap(BufferBatch, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+    if dissolve:
+        return ExplodePolys([unary_union([wkb.loads(result[0]) for result in results])])
+    buffered = [None] * len(polys)
+    for batch, result in zip(batches, results):
+        for j, geom in zip(batch, result):
+            buffered[j] = wkb.loads(geom)
+    return buffered